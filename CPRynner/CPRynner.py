@@ -5,18 +5,23 @@ clusterview and runnoncluster plugins.
 
 from future import *
 
-# Libsubmit creates a .script file in the working directory.
-# To avoid clutter, we run in a temp directory
-import tempfile, os
-workdir = tempfile.mkdtemp()
-os.chdir(workdir)
-
+# Rynner, libsubmit and paramiko are imported when first connecting to
+# the cluster, so that loading the plugins does not slow down CellProfiler
+import tempfile, os, posixpath, shutil, time, logging, hashlib
 import wx
-from rynner.rynner import Rynner
-from libsubmit import SSHChannel
-from libsubmit.providers.slurm.slurm import SlurmProvider
-from libsubmit.launchers.launchers import SimpleLauncher
-from libsubmit.channels.errors import SSHException
+
+from .transfer import TransferPool, TransferManifest, list_remote_files
+from . import slurm, progress
+from .session import Session, connection_errors, is_active, set_keepalive
+from .runcache import RunCache, read_runs
+
+logger = logging.getLogger(__name__)
+
+# Seconds between keepalive packets on connections to the cluster
+KEEPALIVE = 30
+
+# Used when the partition is not chosen from the partitions on the cluster
+DEFAULT_PARTITION = 'compute'
 
 
 class clusterSettingDialog(wx.Dialog):
@@ -26,7 +31,7 @@ class clusterSettingDialog(wx.Dialog):
 
     def __init__(self, cluster_address, tasks_per_node, work_dir, setup_script ):
         """Constructor"""
-        super(clusterSettingDialog, self).__init__(None, title="Login", size = (420,480))
+        super(clusterSettingDialog, self).__init__(None, title="Login", size = (420,600))
 
         self.panel = wx.Panel(self)
 
@@ -61,6 +66,39 @@ class clusterSettingDialog(wx.Dialog):
         self.max_runtime = wx.SpinCtrl(self.panel, value = str(max_runtime), size=(100, -1))
         max_runtime_sizer.Add(self.max_runtime, 0, wx.ALL, 5)
 
+        # node_memory field
+        node_memory = str( cluster_node_memory() )
+        node_memory_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        node_memory_label = wx.StaticText(self.panel, label="Memory per node (GB):", size=(300, -1))
+        node_memory_label.SetToolTip(wx.ToolTip(
+            "The memory available to jobs on a compute node. Used with the memory per task set in RunOnCluster to avoid running out of memory. Set to 0 if unknown."
+        ))
+        node_memory_sizer.Add(node_memory_label, 0, wx.ALL|wx.CENTER, 5)
+        self.node_memory = wx.SpinCtrl(self.panel, value = node_memory, size=(100, -1), min=0, max=100000)
+        node_memory_sizer.Add(self.node_memory, 0, wx.ALL, 5)
+
+        # transfer_channels field
+        transfer_channels = str( cluster_transfer_channels() )
+        transfer_channels_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        transfer_channels_label = wx.StaticText(self.panel, label="Parallel transfers:", size=(300, -1))
+        transfer_channels_label.SetToolTip(wx.ToolTip(
+            "The number of connections used for uploading and downloading files at the same time. More connections can make better use of a fast network."
+        ))
+        transfer_channels_sizer.Add(transfer_channels_label, 0, wx.ALL|wx.CENTER, 5)
+        self.transfer_channels = wx.SpinCtrl(self.panel, value = transfer_channels, size=(100, -1), min=1, max=32)
+        transfer_channels_sizer.Add(self.transfer_channels, 0, wx.ALL, 5)
+
+        # refresh_interval field
+        refresh_interval = str( cluster_refresh_interval() )
+        refresh_interval_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        refresh_interval_label = wx.StaticText(self.panel, label="Refresh interval (minutes):", size=(300, -1))
+        refresh_interval_label.SetToolTip(wx.ToolTip(
+            "How often ClusterView checks the status of the runs in the background. Set to 0 to only update when the Update button is pressed."
+        ))
+        refresh_interval_sizer.Add(refresh_interval_label, 0, wx.ALL|wx.CENTER, 5)
+        self.refresh_interval = wx.SpinCtrl(self.panel, value = refresh_interval, size=(100, -1), min=0, max=1440)
+        refresh_interval_sizer.Add(self.refresh_interval, 0, wx.ALL, 5)
+
         # work_dir field
         work_dir_sizer = wx.BoxSizer(wx.HORIZONTAL)
         work_dir_label = wx.StaticText(self.panel, label="Working Directory:", size=(100, -1))
@@ -97,6 +135,9 @@ class clusterSettingDialog(wx.Dialog):
         self.tasks_per_node.Bind( wx.EVT_TEXT_ENTER, lambda e: wx.PostEvent(self, button_event) )
         self.max_runtime.Bind( wx.EVT_TEXT_ENTER, lambda e: wx.PostEvent(self, button_event) )
         self.max_runtime.Bind( wx.EVT_TEXT_ENTER, lambda e: wx.PostEvent(self, button_event) )
+        self.node_memory.Bind( wx.EVT_TEXT_ENTER, lambda e: wx.PostEvent(self, button_event) )
+        self.transfer_channels.Bind( wx.EVT_TEXT_ENTER, lambda e: wx.PostEvent(self, button_event) )
+        self.refresh_interval.Bind( wx.EVT_TEXT_ENTER, lambda e: wx.PostEvent(self, button_event) )
         self.work_dir.Bind( wx.EVT_TEXT_ENTER, lambda e: wx.PostEvent(self, button_event) )
 
         # Build the layout
@@ -104,6 +145,9 @@ class clusterSettingDialog(wx.Dialog):
         main_sizer.Add(cluster_address_sizer, 0, wx.ALL, 5)
         main_sizer.Add(tasks_per_node_sizer, 0, wx.ALL, 5)
         main_sizer.Add(max_runtime_sizer, 0, wx.ALL, 5)
+        main_sizer.Add(node_memory_sizer, 0, wx.ALL, 5)
+        main_sizer.Add(transfer_channels_sizer, 0, wx.ALL, 5)
+        main_sizer.Add(refresh_interval_sizer, 0, wx.ALL, 5)
         main_sizer.Add(work_dir_sizer, 0, wx.ALL, 5)
         main_sizer.Add(setup_script_label_sizer, 0, wx.ALL, 5)
         main_sizer.Add(setup_script_field_sizer, 0, wx.ALL, 5)
@@ -240,6 +284,44 @@ def cluster_max_runtime():
         max_runtime = ''
     return int(max_runtime)
 
+def cluster_node_memory():
+    cnfg = wx.Config('CPRynner')
+    if cnfg.Exists('node_memory'):
+        node_memory = cnfg.Read('node_memory')
+    else:
+        node_memory = '0'
+    return int(node_memory)
+
+def cluster_transfer_channels():
+    cnfg = wx.Config('CPRynner')
+    if cnfg.Exists('transfer_channels'):
+        transfer_channels = cnfg.Read('transfer_channels')
+    else:
+        transfer_channels = '4'
+    return int(transfer_channels)
+
+def cluster_refresh_interval():
+    cnfg = wx.Config('CPRynner')
+    if cnfg.Exists('refresh_interval'):
+        refresh_interval = cnfg.Read('refresh_interval')
+    else:
+        refresh_interval = '5'
+    return int(refresh_interval)
+
+def cluster_cache_dir():
+    ''' The upload cache on the cluster, shared by all runs
+    '''
+    username = CPRynner().provider.channel.username
+    return posixpath.join(cluster_work_dir().format(username=username), 'cache')
+
+def local_data_dir():
+    ''' A local directory for data kept between sessions
+    '''
+    path = os.path.join(wx.StandardPaths.Get().GetUserDataDir(), 'CPRynner')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
 def update_cluster_parameters():
     cluster_address = cluster_url()
     work_dir = cluster_work_dir()
@@ -251,6 +333,9 @@ def update_cluster_parameters():
         cluster_address = dialog.cluster_address.GetValue()
         tasks_per_node = dialog.tasks_per_node.GetValue()
         max_runtime = dialog.max_runtime.GetValue()
+        transfer_channels = dialog.transfer_channels.GetValue()
+        node_memory = dialog.node_memory.GetValue()
+        refresh_interval = dialog.refresh_interval.GetValue()
         work_dir = dialog.work_dir.GetValue()
         setup_script = dialog.setup_script.GetValue()
 
@@ -258,12 +343,35 @@ def update_cluster_parameters():
         cnfg.Write('cluster_address', cluster_address)
         cnfg.Write('tasks_per_node', str(tasks_per_node))
         cnfg.Write('max_runtime', str(max_runtime))
+        cnfg.Write('transfer_channels', str(transfer_channels))
+        cnfg.Write('node_memory', str(node_memory))
+        cnfg.Write('refresh_interval', str(refresh_interval))
         cnfg.Write('work_dir', work_dir)
         cnfg.Write('setup_script', setup_script)
 
+        # Resize the transfer pool on next use
+        global pool
+        if pool is not None and pool.size != int(transfer_channels):
+            pool.close()
+            pool = None
+
+        # Use the cache of the new cluster when not logged in
+        global runcache
+        runcache = None
+
     dialog.Destroy()
 
 
+workdir = None
+def _enter_workdir():
+    ''' Libsubmit creates a .script file in the working directory.
+        To avoid clutter, we run in a temp directory
+    '''
+    global workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp()
+        os.chdir(workdir)
+
 def _create_rynner():
     ''' Create an instance of Rynner connected to the cluster
     '''
@@ -272,13 +380,18 @@ def _create_rynner():
     tasks_per_node = cluster_tasks_per_node()
     username, password = _get_username_and_password()
     if username is not None:
+        from rynner.rynner import Rynner
+        from libsubmit import SSHChannel
+        from libsubmit.providers.slurm.slurm import SlurmProvider
+        from libsubmit.launchers.launchers import SimpleLauncher
 
+        _enter_workdir()
         work_dir = work_dir.format(username=username)
 
         tmpdir = tempfile.mkdtemp()
     
         provider = SlurmProvider(
-            'compute',
+            DEFAULT_PARTITION,
             channel=SSHChannel(
                 hostname=hostname,
                 username=username,
@@ -293,6 +406,7 @@ def _create_rynner():
             max_blocks=1,
             launcher = SimpleLauncher(),
         )
+        set_keepalive(provider.channel.ssh_client, KEEPALIVE)
         return Rynner(provider, work_dir)
     else:
         return None
@@ -301,24 +415,355 @@ cprynner = None
 def CPRynner():
     ''' Return a shared instance of Rynner
     '''
-    global cprynner
+    global cprynner, runcache
     if cprynner is None:
+        from libsubmit.channels.errors import SSHException
         try:
             cprynner = _create_rynner()
+            # The cache of the account logged in to
+            runcache = None
         except SSHException:
             wx.MessageBox(
                 'Unable to contact the cluster. The cluster may be offline or you may have a problem with your internet connection.',
                 'Info', wx.OK | wx.ICON_INFORMATION
             )
             return None
+    else:
+        try:
+            _heal_channel(cprynner.provider.channel)
+        except connection_errors() as e:
+            # Keep the credentials, the next call tries again
+            logger.warning("Unable to reconnect to the cluster: {}".format(e))
 
     return cprynner
 
+def _connect_client(channel):
+    ''' Open a new SSH connection with the credentials of a channel, or
+        with keys from the SSH agent
+    '''
+    import paramiko
+    client = paramiko.SSHClient()
+    client.load_system_host_keys()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        channel.hostname,
+        username=channel.username,
+        password=channel.password,
+        allow_agent=True
+    )
+    set_keepalive(client, KEEPALIVE)
+    return client
+
+def _heal_channel(channel):
+    ''' Reconnect the channel used by Rynner if the connection was lost
+    '''
+    if is_active(channel.ssh_client):
+        return
+    logger.info("Reconnecting to the cluster")
+    client = _connect_client(channel)
+    channel.ssh_client = client
+    channel.sftp_client = client.open_sftp()
+
+ssh_session = None
+def session():
+    ''' Return a shared session for commands that can safely be repeated,
+        such as listing files and querying the queue. The session
+        reconnects and retries when the connection is lost
+    '''
+    global ssh_session
+    rynner = cprynner if cprynner is not None else CPRynner()
+    if rynner is None:
+        return None
+    if ssh_session is None:
+        channel = rynner.provider.channel
+        ssh_session = Session(lambda: _connect_client(channel), KEEPALIVE)
+    return ssh_session
+
+def logged_in():
+    ''' True if connected to the cluster, without asking for a login
+    '''
+    return cprynner is not None
+
+pool = None
+def transfer_pool():
+    ''' Return a shared pool of connections for file transfers, logged in
+        with the same credentials as the Rynner instance
+    '''
+    global pool
+    rynner = CPRynner()
+    if rynner is None:
+        return None
+    if pool is None:
+        channel = rynner.provider.channel
+        pool = TransferPool(lambda: _connect_client(channel), cluster_transfer_channels())
+    return pool
+
 def logout():
     ''' Logout and scrap the rynner object
     '''
-    global cprynner
+    global cprynner, pool, ssh_session, partitions, runcache
+    partitions = None
+    runcache = None
+    if pool is not None:
+        pool.close()
+        pool = None
+    if ssh_session is not None:
+        ssh_session.close()
+        ssh_session = None
     if cprynner is not None:
         CPRynner().provider.channel.close()
         cprynner = None
     
+
+
+def _staging_root():
+    return os.path.join(local_data_dir(), 'staging')
+
+def new_staging_dir():
+    ''' A new local folder for the pipeline, scripts and archives written
+        for a run. Each run has its own folder, so that resuming an upload
+        never sends files written for a later run
+    '''
+    root = _staging_root()
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    return tempfile.mkdtemp(prefix='.new_', dir=root)
+
+def keep_staging_dir(run, staging):
+    ''' Name the staging folder of a newly created run after the run and
+        point its uploads there
+    '''
+    folder = os.path.join(_staging_root(), run['id'])
+    os.rename(staging, folder)
+    prefix = staging + os.sep
+    run['uploads'] = [
+        [folder + os.sep + local[len(prefix):] if local.startswith(prefix) else local, dest]
+        for local, dest in run['uploads']
+    ]
+    run['staging_dir'] = folder
+
+def remove_staging_dir(run):
+    ''' Remove the local files written for a run '''
+    if run.get('staging_dir'):
+        shutil.rmtree(run['staging_dir'], ignore_errors=True)
+
+def _transfer_manifest(run):
+    return TransferManifest(
+        os.path.join(local_data_dir(), 'transfers', run['id'] + '.json'), run
+    )
+
+def _read_remote_lines(channel, path):
+    try:
+        remote_file = channel.sftp_client.open(path, 'r')
+    except IOError:
+        return []
+    try:
+        return remote_file.read().decode('utf-8').splitlines()
+    finally:
+        remote_file.close()
+
+def upload_run(run, dialog):
+    ''' Upload the files of a run over the transfer pool, showing progress in
+        dialog. Files recorded as finished in the transfer manifest and
+        confirmed on the cluster are skipped, so an interrupted upload
+        continues where it stopped. Returns False if the upload was cancelled.
+    '''
+    rynner = CPRynner()
+    if rynner is None:
+        return False
+    channel = session()
+    pool = transfer_pool()
+    remote_dir = run['remote_dir']
+    remote_manifest = posixpath.join(remote_dir, TransferManifest.remote_name)
+
+    manifest = _transfer_manifest(run)
+    manifest.run = run
+    if manifest.sources:
+        # The files must not have changed since the upload started
+        changed = manifest.changed_sources()
+        if changed:
+            wx.MessageBox(
+                "The upload cannot be resumed, because files of the run have "
+                "changed or been removed since it started:\n" + "\n".join(changed[:10]),
+                caption="Resume upload",
+                style=wx.OK | wx.ICON_INFORMATION)
+            return False
+    else:
+        manifest.record_sources([local for local, dest in run['uploads']])
+    if manifest.done:
+        remote_sizes = dict(list_remote_files(channel, remote_dir, ['.']))
+        manifest.verify(_read_remote_lines(channel, remote_manifest), remote_sizes)
+    manifest.save()
+
+    files = []
+    for local, dest in run['uploads']:
+        path = posixpath.normpath(posixpath.join(dest, os.path.basename(local)))
+        if not manifest.is_done(path, local):
+            files.append((local, posixpath.join(remote_dir, path)))
+
+    def record_completed():
+        for local, remote, size, checksum in pool.pop_completed():
+            manifest.mark_done(posixpath.relpath(remote, remote_dir), size, checksum)
+        manifest.save()
+        lines = manifest.pop_new_lines()
+        if lines:
+            try:
+                remote_file = channel.sftp_client.open(remote_manifest, 'a')
+                try:
+                    remote_file.write(lines)
+                finally:
+                    remote_file.close()
+            except Exception as e:
+                # Files missing from the cluster manifest are uploaded again
+                logger.warning("Failed to update the transfer manifest on the cluster: {}".format(e))
+
+    pool.start_upload(files)
+    maximum = dialog.GetRange()
+    last_record = time.time()
+    cancelled = False
+    try:
+        while not pool.finished():
+            value = min( maximum, int(maximum*pool.progress()) )
+            if not dialog.Update(value)[0]:
+                cancelled = True
+                pool.cancel()
+            if time.time() - last_record > 10:
+                record_completed()
+                last_record = time.time()
+            time.sleep(0.04)
+        pool.wait()
+    finally:
+        # Record what finished, also when the transfer failed
+        pool.cancel()
+        for thread in pool.threads:
+            thread.join()
+        record_completed()
+
+    if cancelled:
+        return False
+
+    run['upload_status'] = 1
+    run['upload_time'] = time.time()
+    manifest.run = run
+    manifest.save()
+    return True
+
+def submit_run(run):
+    ''' Submit an uploaded run. The transfer manifest and the local copies
+        of the run's scripts and archives are no longer needed after a
+        successful submission.
+    '''
+    rynner = CPRynner()
+    if rynner is None:
+        return False
+    rynner.provider.walltime = run['walltime']
+    rynner.provider.partition = run.get('partition') or DEFAULT_PARTITION
+    rynner.provider.nodes_per_block = run.get('nodes', 1)
+    rynner.provider.overrides = run.get('overrides', '')
+    success = rynner.submit(run)
+    if success:
+        _transfer_manifest(run).remove()
+        remove_staging_dir(run)
+        cache_runs([run])
+    return success
+
+def pending_uploads():
+    ''' Runs that have been created but not submitted, for example because
+        the upload was interrupted
+    '''
+    from box import Box
+    folder = os.path.join(local_data_dir(), 'transfers')
+    runs = []
+    if os.path.isdir(folder):
+        for name in sorted(os.listdir(folder)):
+            if name.endswith('.json'):
+                runs.append(Box(TransferManifest(os.path.join(folder, name)).run))
+    return runs
+
+def discard_upload(run):
+    ''' Forget an unfinished upload
+    '''
+    _transfer_manifest(run).remove()
+    remove_staging_dir(run)
+
+def update_runs(runs, channel=None):
+    ''' Update the status, status time and estimated start time of all runs
+        with a single query to the cluster. Uses the shared session unless
+        a channel is given
+    '''
+    if channel is None:
+        channel = session()
+    if channel is None:
+        return runs
+    return slurm.update_runs(channel, runs)
+
+def update_progress(runs, channel=None):
+    ''' Read the progress of the run folders of all runs with a single
+        query to the cluster. Uses the shared session unless a channel is
+        given
+    '''
+    if channel is None:
+        channel = session()
+    if channel is None:
+        return runs
+    return progress.update_progress(channel, runs)
+
+def remote_runs(rynner, channel=None):
+    ''' All runs on the cluster. Their configurations are read with a
+        single command, falling back to Rynner, which fetches them one by
+        one, if they cannot all be read that way
+    '''
+    from box import Box
+    if channel is None:
+        channel = session()
+    runs = None
+    if channel is not None:
+        runs = read_runs(channel, rynner.path)
+    if runs is None:
+        return rynner.get_runs()
+    return [Box(run) for run in runs]
+
+partitions = None
+def cluster_partitions():
+    ''' The partitions of the cluster and the cores, memory and time limit
+        of their nodes. Queried once per session, empty if the cluster
+        does not provide the information
+    '''
+    global partitions
+    if partitions is None:
+        channel = session()
+        if channel is None:
+            return []
+        try:
+            partitions = slurm.query_partitions(channel)
+        except connection_errors() as e:
+            logger.warning("Could not query the cluster partitions: {}".format(e))
+            return []
+    return partitions
+
+runcache = None
+def run_cache():
+    ''' The local cache of run descriptions. Each cluster and user has
+        their own, so that runs of another account are never queried
+    '''
+    global runcache
+    if runcache is None:
+        if cprynner is not None:
+            channel = cprynner.provider.channel
+            hostname, username = channel.hostname, channel.username
+        else:
+            hostname, username = cluster_url(), wx.Config('CPRynner').Read('username')
+        key = hashlib.sha1(u'{}\n{}'.format(hostname, username).encode('utf-8')).hexdigest()
+        runcache = RunCache(os.path.join(local_data_dir(), 'runs-{}.sqlite'.format(key[:16])))
+    return runcache
+
+def cached_runs():
+    ''' The runs known locally, without contacting the cluster
+    '''
+    from box import Box
+    return [Box(run) for run in run_cache().runs()]
+
+def cache_runs(runs, replace=False):
+    ''' Store runs in the local cache, see RunCache.save
+    '''
+    run_cache().save(runs, replace)
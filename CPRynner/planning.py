@@ -0,0 +1,401 @@
+"""
+Plans how the images of a batch are divided into run folders and writes
+the scripts that process the run folders on the cluster. Work per image
+is done with numpy or in a single pass over the file list, so that
+planning a million files takes under a second.
+"""
+
+import heapq
+import numpy as np
+
+from .results import KEEP_IMAGE_NUMBERS
+
+# Images shared by the run folders are copied once to each node
+NODE_STAGE = '${TMPDIR:-/tmp}/cellprofiler_images_$SLURM_JOB_ID'
+
+# Run folders that have been processed are marked by a file in this folder,
+# those where CellProfiler failed by a file in FAILED_FOLDER instead
+FINISHED_FOLDER = 'finished'
+FAILED_FOLDER = 'failed'
+
+# Keeps the exit status of CellProfiler until the progress count is done
+STATUS_FILE = 'exit_status'
+
+# Results of all run folders merged on the cluster with results.py
+MERGE_FOLDER = 'merged'
+
+# The chunks of a dynamic run are processed in run folders inside this
+# folder, created by the workers as they claim the chunks
+CHUNK_FOLDER = 'chunks'
+
+# The script processing any chunk, and the number, first and last
+# measurement of each chunk, one chunk per line
+CHUNK_SCRIPT = 'cellprofiler_chunk'
+CHUNK_RANGES = 'chunk_ranges'
+
+# Each run folder keeps the number of image sets processed, the number of
+# image sets in the folder, the start time and the time of the last update
+# in this file
+PROGRESS_FILE = 'progress'
+
+# Counts the image sets in the CellProfiler log, which has a line for each
+# module run on an image set. A new image number means that the previous
+# image set is done. If the log has no such lines, the folder is counted
+# done at the end. read takes a line at a time from a pipe, unlike awk,
+# which may wait for a full buffer.
+PROGRESS_LOOP = (
+    'count=0; image=; start=$(date +%s); echo "0 {total} $start $start" > {file}; '
+    'while IFS= read -r line; do case $line in *"Image # "[0-9]*) '
+    'n=${{line#*Image # }}; n=${{n%%[!0-9]*}}; '
+    'if [ "$n" != "$image" ]; then [ -z "$image" ] || count=$((count+1)); image=$n; '
+    'echo "$count {total} $start $(date +%s)" > {file}; fi;; esac; done; '
+    '[ -z "$image" ] && count={total} || count=$((count+1)); '
+    'echo "$count {total} $start $(date +%s)" > {file}'
+)
+
+
+def normalize_file_list(file_list):
+    ''' Convert the image URLs of a pipeline file list to local paths.
+        The list is joined into one string so that each replacement is a
+        single pass over all file names '''
+    if len(file_list) == 0:
+        return []
+    text = '\n'.join(file_list)
+    text = text.replace('file:///', '').replace('file:', '').replace('%20', ' ')
+    return text.split('\n')
+
+
+def measurement_index(n_images, n_measurements, groups_first=True):
+    ''' The measurement each image belongs to '''
+    index = np.arange(n_images)
+    if groups_first:
+        return index // (n_images // n_measurements)
+    return index % n_measurements
+
+
+def group_images(n_images, n_measurements, measurements_per_run, groups_first=True):
+    ''' Divide images into groups with the same number of measurements.
+        Returns the group number of each image '''
+    return measurement_index(n_images, n_measurements, groups_first) // measurements_per_run
+
+
+def balance_groups(n_images, n_measurements, n_groups, costs, groups_first=True):
+    ''' Divide images into groups with roughly equal total cost.
+        Measurements are assigned greedily, most expensive first, to the group
+        with the lowest total so far. Returns the group number of each image '''
+    measurements = np.minimum(measurement_index(n_images, n_measurements, groups_first), n_measurements-1)
+    measurement_costs = np.bincount(measurements, weights=costs, minlength=n_measurements)
+
+    # Ties go to the group with fewest measurements
+    groups = [(0, 0, g) for g in range(n_groups)]
+    group_of = np.zeros(n_measurements, dtype=int)
+    for m in np.argsort(-measurement_costs, kind='mergesort').tolist():
+        load, count, g = heapq.heappop(groups)
+        group_of[m] = g
+        heapq.heappush(groups, (load + measurement_costs[m], count + 1, g))
+    return group_of[measurements]
+
+
+def chunk_ranges(n_measurements, chunk_size):
+    ''' First and last measurement, counting from 1, of each chunk '''
+    return [
+        (first, min(first + chunk_size - 1, n_measurements))
+        for first in range(1, n_measurements + 1, chunk_size)
+    ]
+
+
+def tracked_command(command, n_sets, log, progress=PROGRESS_FILE):
+    ''' Run a cellprofiler command, appending its log to the file log and
+        keeping count of the image sets processed in the file progress.
+        The standard output is passed through. The exit status of the
+        command is left in the shell variable status '''
+    return '{{ {{ {{ {0}; }} 2>&1 1>&3; echo $? > {1}; }} | tee -a {2} | {{ {3}; }}; }} 3>&1; status=$(cat {1}); rm -f {1}'.format(
+        command, STATUS_FILE, log, PROGRESS_LOOP.format(total=n_sets, file=progress)
+    )
+
+
+def archive_ranges(n_measurements, n_groups):
+    ''' First and last measurement, counting from 1, of each group when
+        dividing an archive '''
+    n_per_group = int(n_measurements/n_groups)
+    n_additional = int(n_measurements%n_groups)
+    ranges = []
+    for g in range(n_groups):
+        if g < n_additional:
+            ranges.append(((n_per_group+1)*g + 1, (n_per_group+1)*(g+1)))
+        else:
+            ranges.append((n_per_group*g + n_additional + 1, n_per_group*(g+1) + n_additional))
+    return ranges
+
+
+class RunPlan(object):
+    ''' The run folders of a batch.
+
+        ranges holds the first and last measurement processed in each run
+        folder. groups holds the run folder of each image, or is None when
+        all run folders read from a shared images folder. archive is True
+        when the images are in a single archive file. chunked is True when
+        the run folders are chunks claimed by workers, which are processed
+        in CHUNK_FOLDER by a single CHUNK_SCRIPT.
+    '''
+
+    def __init__(self, ranges, groups=None, archive=False, chunked=False):
+        self.ranges = ranges
+        self.groups = groups
+        self.archive = archive
+        self.chunked = chunked
+
+    @property
+    def n_runs(self):
+        return len(self.ranges)
+
+    @property
+    def shared(self):
+        return self.groups is None
+
+    @property
+    def up(self):
+        ''' The path from a run folder to the run directory '''
+        return '../..' if self.chunked else '..'
+
+    def folder(self, g):
+        ''' The path of run folder g in the run directory '''
+        if self.chunked:
+            return chunk_folder(g)
+        return 'run{}'.format(g)
+
+    def image_uploads(self, file_list):
+        ''' Uploads of the images into their folders on the cluster, as
+            (local path, remote folder) pairs '''
+        if self.shared:
+            return [(name, 'images') for name in file_list]
+        folders = np.array(['run{}/images'.format(g) for g in range(self.n_runs)], dtype=object)
+        return list(zip(file_list, folders[self.groups]))
+
+    def merge_command(self):
+        ''' The command merging the results of all run folders into
+            MERGE_FOLDER. Run folders reading from a shared image list
+            already number the images within the whole list '''
+        options = ' ' + KEEP_IMAGE_NUMBERS if self.shared else ''
+        return 'python results.py{} {}/results {}/results'.format(
+            options, MERGE_FOLDER, self.folder('*')
+        )
+
+    def run_script(self, g, unpack='', stage=False):
+        ''' The script processing run folder g. With stage, the images are
+            copied to node-local scratch and the results are written there
+            and copied back in one go at the end. The script marks the run
+            folder finished in FINISHED_FOLDER when CellProfiler succeeded,
+            or in FAILED_FOLDER when it failed '''
+        first, last = self.ranges[g]
+        return self.folder_script(first, last, self.n_sets(g), g, unpack, stage)
+
+    def chunk_script(self, stage=False):
+        ''' The CHUNK_SCRIPT of a chunked plan, processing the chunk K from
+            measurement FIRST to LAST, all three given in the environment '''
+        return self.folder_script('$FIRST', '$LAST', '$((LAST-FIRST+1))', '$K', stage=stage)
+
+    def chunk_list(self):
+        ''' The CHUNK_RANGES file of a chunked plan '''
+        return ''.join(
+            '{} {} {}\n'.format(k, first, last) for k, (first, last) in enumerate(self.ranges)
+        )
+
+    def folder_script(self, first, last, n_sets, name, unpack='', stage=False):
+        return '{0}; if [ "$status" = 0 ]; then marker={2}; else marker={3}; fi; mkdir -p {1}/$marker; touch {1}/$marker/{4}'.format(
+            self.process_script(first, last, n_sets, unpack, stage), self.up, FINISHED_FOLDER, FAILED_FOLDER, name
+        )
+
+    def n_sets(self, g):
+        ''' The number of image sets processed in run folder g '''
+        first, last = self.ranges[g]
+        return last - first + 1
+
+    def process_script(self, first, last, n_sets, unpack='', stage=False):
+        up = self.up
+        log = up + '/cellprofiler_output'
+        if stage:
+            return self.staged_run_script(first, last, n_sets, unpack)
+        if self.archive:
+            # All run folders read the same archive through a link instead of
+            # each copying it
+            command = "cellprofiler -c -p {}/Batch_data.h5 -o results -i images -f {} -l {}".format(up, first, last)
+            return "ln -sfn {}/images images; {}; rm images".format(
+                up, tracked_command(command, n_sets, log)
+            )
+        if self.shared:
+            command = "cellprofiler -c -p {0}/Batch_data.h5 -o results -i {0}/images -f {1} -l {2}".format(up, first, last)
+            return tracked_command(command, n_sets, log)
+        command = "cellprofiler -c -p {}/Batch_data.h5 -o results -i images -f 1 -l {}".format(up, last)
+        return unpack + tracked_command(command, n_sets, log) + "; rm -r images"
+
+    def staged_run_script(self, first, last, n_sets, unpack=''):
+        ''' The script processing measurements first to last in a staging
+            folder on node-local scratch '''
+        if self.shared:
+            # The first process on each node copies the shared images, the
+            # others wait for it. If the node folder cannot be created or
+            # the copy fails, the shared images are used.
+            prepare = [
+                'NODE_STAGE={}'.format(NODE_STAGE),
+                'if mkdir -p $(dirname $NODE_STAGE) && mkdir $NODE_STAGE 2>/dev/null; then (cp -r {}/images $NODE_STAGE/ || rm -rf $NODE_STAGE/images); touch $NODE_STAGE/.ready; fi'.format(self.up),
+                'while [ -d $NODE_STAGE ] && [ ! -e $NODE_STAGE/.ready ]; do sleep 5; done',
+                'IMAGES=$NODE_STAGE/images',
+                '[ -d $IMAGES ] || IMAGES=$RUN/{}/images'.format(self.up),
+                'mkdir -p $STAGE',
+            ]
+        else:
+            prepare = [
+                'mkdir -p $STAGE',
+                'IMAGES=images',
+                'cp -r images $STAGE/ || IMAGES=$RUN/images',
+            ]
+        script = [
+            'RUN=$PWD',
+            'STAGE=${TMPDIR:-/tmp}/cellprofiler_$$',
+        ] + prepare + [
+            'cd $STAGE',
+            tracked_command(
+                'cellprofiler -c -p $RUN/{}/Batch_data.h5 -o results -i $IMAGES -f {} -l {}'.format(self.up, first, last),
+                n_sets, '$RUN/{}/cellprofiler_output'.format(self.up), '$RUN/' + PROGRESS_FILE
+            ),
+            'mkdir -p $RUN/results',
+            'cp -r results/. $RUN/results/',
+            'cd $RUN',
+            'rm -rf $STAGE',
+        ]
+        if not self.shared:
+            script.append('rm -r images')
+        return unpack + '; '.join(script)
+
+
+def plan_images(n_images, n_images_per_measurement, n_tasks, groups_first=True, costs=None, chunk_size=None):
+    ''' Plan the run folders for a list of image files.
+
+        The images are divided between n_tasks run folders, balancing the
+        total cost of the images if costs are given. If chunk_size is
+        given, the images are shared and each run folder processes
+        chunk_size measurements.
+    '''
+    n_measurements = n_images // n_images_per_measurement
+    if chunk_size:
+        return RunPlan(chunk_ranges(n_measurements, chunk_size), chunked=True)
+
+    if costs is not None:
+        n_groups = min(n_tasks, n_measurements)
+        groups = balance_groups(n_images, n_measurements, n_groups, costs, groups_first)
+    else:
+        measurements_per_run = n_measurements // n_tasks + 1
+        groups = group_images(n_images, n_measurements, measurements_per_run, groups_first)
+        n_groups = int(groups.max()) + 1
+
+    counts = np.bincount(groups, minlength=n_groups) // n_images_per_measurement
+    return RunPlan([(1, c) for c in counts.tolist()], groups)
+
+
+def plan_archive(n_measurements, n_tasks, chunk_size=None):
+    ''' Plan the run folders for a single image archive '''
+    if chunk_size:
+        return RunPlan(chunk_ranges(n_measurements, chunk_size), archive=True, chunked=True)
+    return RunPlan(archive_ranges(n_measurements, n_tasks), archive=True)
+
+
+def chunk_folder(k):
+    ''' The run folder of chunk k in the run directory '''
+    return '{}/run{}'.format(CHUNK_FOLDER, k)
+
+
+def worker_script():
+    ''' A worker that claims the chunks listed in CHUNK_RANGES from a queue
+        shared by all workers until none are left, processing each in its
+        run folder with CHUNK_SCRIPT. Creating a directory is atomic, also
+        on shared file systems, so each chunk is claimed exactly once '''
+    return (
+        "#!/bin/bash\n"
+        "while read k first last; do\n"
+        "    mkdir queue/$k 2>/dev/null || continue\n"
+        "    mkdir -p {0}/run$k\n"
+        "    (cd {0}/run$k; K=$k FIRST=$first LAST=$last bash ../../{1})\n"
+        "done < {2}\n"
+    ).format(CHUNK_FOLDER, CHUNK_SCRIPT, CHUNK_RANGES)
+
+
+def worker_concurrency(tasks_per_node, node_memory=0, task_memory=0):
+    ''' The number of CellProfiler processes to run at the same time on a
+        node. Limited by the number of tasks per node and, when both are
+        known, by the number of tasks that fit into the node memory '''
+    concurrency = tasks_per_node
+    if node_memory > 0 and task_memory > 0:
+        concurrency = min(concurrency, int(node_memory // task_memory))
+    return max(1, concurrency)
+
+
+def job_script(plan, setup_script, prepare='', n_nodes=1, tasks_per_node=1,
+               array=False, array_throttle=0, dynamic=False,
+               node_memory=0, task_memory=0, stage=False, merge=False):
+    ''' The job script processing the run folders of a plan.
+
+        prepare is run once before processing, for example to unpack the
+        images. Memory is given in GB, 0 for unknown. With stage, images
+        staged on the nodes are removed at the end. With merge, the results
+        of all run folders are merged into MERGE_FOLDER once all are done.
+        Returns the script and the additional sbatch options.
+    '''
+    n_runs = plan.n_runs
+    cleanup = ''
+    if stage and plan.shared:
+        cleanup = '; rm -rf {}'.format(NODE_STAGE)
+    concurrency = worker_concurrency(tasks_per_node, node_memory, task_memory)
+    worker = 'xargs -P {} -n 1 -IX bash -c "cd runX ; ./cellprofiler_runX; "'.format(concurrency)
+    options = []
+    if array:
+        # Each array task processes one run folder. The first task to
+        # start runs the preparation, the others wait for it
+        if prepare:
+            prepare = 'if mkdir .prepare 2>/dev/null; then {} touch .prepared; fi; while [ ! -e .prepared ]; do sleep 10; done; '.format(prepare)
+        script = '{}; {}cd run$SLURM_ARRAY_TASK_ID; ./cellprofiler_run$SLURM_ARRAY_TASK_ID{};'.format(
+            setup_script, prepare, cleanup
+        )
+        if merge:
+            # The last task to finish merges the results
+            script += ' cd ..; if [ $( (ls {}; ls {}) 2>/dev/null | wc -l) -ge {} ] && mkdir .merge 2>/dev/null; then {}; fi;'.format(
+                FINISHED_FOLDER, FAILED_FOLDER, n_runs, plan.merge_command()
+            )
+        array_option = '--array=0-{}'.format(n_runs-1)
+        if array_throttle > 0:
+            array_option += '%{}'.format(array_throttle)
+        options += ['--ntasks=1', '--cpus-per-task=1', array_option]
+        if task_memory > 0:
+            options += ['--mem={}M'.format(int(task_memory*1024))]
+    else:
+        if dynamic:
+            # Workers claim run folders from the queue until none are left
+            prepare += 'mkdir -p queue; '
+            node_command = 'seq 1 {0} | xargs -P {0} -n 1 -IX ./cellprofiler_worker'.format(concurrency)
+        elif n_nodes == 1:
+            node_command = 'printf %s\\\\n {{0..{}}} | {}'.format(n_runs-1, worker)
+        else:
+            # Each node takes every n_nodes'th run folder
+            node_command = 'seq $SLURM_PROCID {} {} | {}'.format(n_nodes, n_runs-1, worker)
+
+        node_command += cleanup
+        if n_nodes == 1:
+            script = '{}; {}{};'.format(setup_script, prepare, node_command)
+        else:
+            # Start one task on each node
+            script = "{}; {}srun --nodes={} --ntasks={} --ntasks-per-node=1 --cpus-per-task={} bash -c '{}';".format(
+                setup_script, prepare, n_nodes, n_nodes, tasks_per_node, node_command
+            )
+        if plan.shared and not plan.archive:
+            script += ' rm -r images;'
+        if merge:
+            script += ' {};'.format(plan.merge_command())
+
+        options += ['--ntasks-per-node=1', '--cpus-per-task={}'.format(tasks_per_node)]
+        if task_memory > 0:
+            options += ['--mem={}M'.format(int(concurrency*task_memory*1024))]
+
+    script = script.replace('\r\n','\n')
+    script = script.replace(';;', ';')
+    overrides = '\n'.join('#SBATCH ' + option for option in options)
+    return script, overrides
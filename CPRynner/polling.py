@@ -0,0 +1,64 @@
+"""
+Periodic background queries of the cluster. Callers in the GUI pass a
+deliver function that hands the result to the main thread, for example
+with wx.CallAfter.
+"""
+
+import threading
+
+
+class Poller(object):
+    ''' Calls fetch in a background thread every interval seconds and passes
+        the result to deliver.
+
+        After a failure the interval is doubled, up to max_interval, and it
+        is reset after the next success. With an interval of 0 fetch is only
+        called when refresh() is called. A result of None is not delivered.
+    '''
+
+    def __init__(self, fetch, deliver, interval, max_interval=3600, on_error=None):
+        self.fetch = fetch
+        self.deliver = deliver
+        self.interval = interval
+        self.max_interval = max(max_interval, interval)
+        self.on_error = on_error
+        self.failures = 0
+        self.stopped = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def refresh(self):
+        ''' Fetch now instead of waiting for the interval '''
+        self.wake.set()
+
+    def stop(self):
+        ''' Stop polling. A fetch already running is finished but not delivered '''
+        self.stopped = True
+        self.wake.set()
+
+    def delay(self):
+        ''' Seconds until the next fetch, None to wait for refresh() '''
+        if self.interval <= 0:
+            return None
+        return min(self.max_interval, self.interval * 2**self.failures)
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.delay())
+            self.wake.clear()
+            if self.stopped:
+                return
+            try:
+                result = self.fetch()
+            except Exception as e:
+                self.failures += 1
+                if self.on_error is not None and not self.stopped:
+                    self.on_error(e)
+                continue
+            self.failures = 0
+            if result is not None and not self.stopped:
+                self.deliver(result)
@@ -0,0 +1,141 @@
+"""
+Progress of running jobs, read in one command from the progress files the
+run scripts keep in each run folder.
+"""
+
+import posixpath
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from .planning import PROGRESS_FILE, CHUNK_FOLDER
+
+# Runs without new progress for this many seconds are shown as stalled
+STALLED_AFTER = 30*60
+
+
+def progress_command(remote_dirs):
+    ''' A single command printing the progress files of all run folders
+        of the given runs, each line prefixed with the path of the file '''
+    return 'grep -s -H . {}'.format(' '.join(
+        quote(d) + folders + PROGRESS_FILE
+        for d in remote_dirs for folders in ['/run*/', '/' + CHUNK_FOLDER + '/run*/']
+    ))
+
+
+def parse_progress(output):
+    ''' Parse the output of progress_command into a dict by run directory
+        of dicts by run folder, holding the image sets 'done', the 'total'
+        and the 'start' and 'updated' times. Files being rewritten while
+        they are read are skipped '''
+    progress = {}
+    for line in output.splitlines():
+        path, _, values = line.rpartition(':')
+        values = values.split()
+        if len(values) != 4:
+            continue
+        try:
+            done, total, start, updated = [int(v) for v in values]
+        except ValueError:
+            continue
+        folder = posixpath.dirname(path)
+        run_dir = posixpath.dirname(folder)
+        if posixpath.basename(run_dir) == CHUNK_FOLDER:
+            run_dir = posixpath.dirname(run_dir)
+        group = progress.setdefault(run_dir, {})
+        group[posixpath.basename(folder)] = {
+            'done': done, 'total': total, 'start': start, 'updated': updated,
+        }
+    return progress
+
+
+def group_summary(group):
+    ''' Percent complete, image sets per second and the projected finish
+        time of a run folder. The rate and finish time are None until an
+        image set is done '''
+    done, total = group['done'], group['total']
+    elapsed = group['updated'] - group['start']
+    rate = done / float(elapsed) if done > 0 and elapsed > 0 else None
+    if done >= total:
+        finish = group['updated']
+    elif rate is not None:
+        finish = group['updated'] + (total - done) / rate
+    else:
+        finish = None
+    return {
+        'done': done,
+        'total': total,
+        'percent': 100.0 * done / total if total > 0 else 0.0,
+        'rate': rate,
+        'finish': finish,
+        'updated': group['updated'],
+    }
+
+
+def summarize(groups, total=None, now=None):
+    ''' The progress of a run from the progress of its run folders, see
+        group_summary. total is the number of image sets in the run,
+        including run folders that have not started. The rate is the
+        number of image sets done since the first folder started, over
+        all folders. 'updated' is the last update of the folders still
+        being processed, None if there are none '''
+    if now is None:
+        now = time.time()
+    summaries = dict((name, group_summary(g)) for name, g in groups.items())
+    done = sum(g['done'] for g in groups.values())
+    if total is None:
+        total = sum(g['total'] for g in groups.values())
+    summary = {
+        'done': done,
+        'total': total,
+        'percent': 100.0 * done / total if total > 0 else 0.0,
+        'rate': None,
+        'finish': None,
+        'updated': max([g['updated'] for g in groups.values() if g['done'] < g['total']] or [None]),
+        'groups': summaries,
+    }
+    if len(groups) > 0:
+        elapsed = now - min(g['start'] for g in groups.values())
+        if done > 0 and elapsed > 0:
+            summary['rate'] = done / float(elapsed)
+            summary['finish'] = now + (total - done) / summary['rate']
+    return summary
+
+
+def format_progress(summary, now=None):
+    ''' A short description of the progress of a run or run folder '''
+    if now is None:
+        now = time.time()
+    text = '{:.0f}%'.format(summary['percent'])
+    if summary['done'] >= summary['total']:
+        return text
+    if summary['rate'] is not None:
+        text += ', {:.2f}/s'.format(summary['rate'])
+    if summary['updated'] is not None and now - summary['updated'] > STALLED_AFTER:
+        text += ', stalled {:.0f} min'.format((now - summary['updated']) / 60)
+    elif summary['finish'] is not None:
+        # Show the day for finish times beyond the next day
+        style = '%H:%M' if summary['finish'] - now < 24*3600 else '%d %b %H:%M'
+        text += ', done ' + time.strftime(style, time.localtime(summary['finish']))
+    return text
+
+
+def update_progress(channel, runs):
+    ''' Read the progress of a list of runs in one round trip and store it
+        as the 'progress' of each run that has started, see summarize '''
+    runs = [run for run in runs if run.get('remote_dir')]
+    if len(runs) == 0:
+        return runs
+    retcode, stdout, stderr = channel.execute_wait(
+        progress_command([run['remote_dir'] for run in runs]), walltime=60
+    )
+    progress = parse_progress(stdout)
+    now = time.time()
+    for run in runs:
+        groups = progress.get(posixpath.normpath(run['remote_dir']))
+        if groups:
+            run['progress'] = summarize(groups, run.get('image_sets'), now)
+    return runs
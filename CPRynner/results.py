@@ -0,0 +1,186 @@
+"""
+Merging of the result files written by the run folders of a batch.
+
+Each run folder writes its own copy of every measurement csv file. Run
+folders with their own images number them from 1, and the merged file
+numbers the images of each run after those already in the file. Run
+folders processing a range of a shared image list already use the image
+numbers of the whole list, which are kept. The module also runs on the
+cluster.
+"""
+
+import csv
+import os
+import re
+import shutil
+import sys
+
+
+def open_csv(path, mode='r'):
+    ''' Open a file for the csv module in both Python 2 and 3 '''
+    if sys.version_info[0] < 3:
+        return open(path, mode + 'b')
+    return open(path, mode, newline='')
+
+
+def is_image_number_column(name):
+    ''' Columns refering to image numbers, including the ImageNumber_First
+        and ImageNumber_Second columns of relationship files. Object numbers
+        count from 1 in each image and stay valid when the images are
+        renumbered '''
+    return name == 'ImageNumber' or name.startswith('ImageNumber_') or name.endswith('_ImageNumber')
+
+
+class CSVMerger(object):
+    ''' Appends csv files to destination files in a single pass.
+
+        The header and largest image number of each destination are read
+        once and kept, so merging many files into the same destination does
+        not rescan it. Rows with columns in a different order than the
+        destination are rearranged to match it. Without renumber, the image
+        numbers are copied unchanged.
+
+        The files of a run folder are merged after calling start_folder,
+        which moves the image numbers of all of them by the same offset.
+        Otherwise each file is numbered after the images already in its
+        destination.
+    '''
+
+    def __init__(self, renumber=True):
+        self.renumber = renumber
+        self.headers = {}
+        self.offsets = {}
+        self.folder_offset = None
+
+    def _scan(self, destination):
+        with open_csv(destination) as infile:
+            reader = csv.reader(infile)
+            header = next(reader, [])
+            columns = [i for i, name in enumerate(header) if is_image_number_column(name)]
+            offset = 0
+            for row in reader:
+                for i in columns:
+                    if i < len(row) and row[i]:
+                        offset = max(offset, int(row[i]))
+        self.headers[destination] = header
+        self.offsets[destination] = offset
+
+    def _largest(self, destination):
+        if destination not in self.headers:
+            if os.path.isfile(destination):
+                self._scan(destination)
+            else:
+                self.headers[destination] = None
+                self.offsets[destination] = 0
+        return self.offsets[destination]
+
+    def start_folder(self, destinations):
+        ''' Start merging the csv files of another run folder into the given
+            destination files. Its images are numbered after the largest
+            image number in any of the destinations, as the object files
+            miss the last images when those have no objects '''
+        self.folder_offset = max([self._largest(d) for d in destinations] or [0])
+
+    def merge(self, source, destination):
+        ''' Write the data rows of source at the end of destination, or copy
+            source to destination if it does not exist yet '''
+        offset = self._largest(destination)
+        if self.folder_offset is not None:
+            offset = self.folder_offset
+        if not self.renumber:
+            offset = 0
+
+        with open_csv(source) as infile:
+            reader = csv.reader(infile)
+            header = next(reader, None)
+            if header is None:
+                return
+            new_file = self.headers[destination] is None
+            if new_file:
+                self.headers[destination] = header
+            target_header = self.headers[destination]
+
+            # Position of each destination column in the source rows
+            order = None
+            if header != target_header:
+                position = dict((name, i) for i, name in enumerate(header))
+                order = [position.get(name) for name in target_header]
+            columns = [i for i, name in enumerate(target_header) if is_image_number_column(name)]
+
+            largest = max(offset, self.offsets[destination])
+            with open_csv(destination, 'a') as outfile:
+                writer = csv.writer(outfile)
+                if new_file:
+                    writer.writerow(header)
+                for row in reader:
+                    if order is not None:
+                        row = [row[i] if i is not None and i < len(row) else '' for i in order]
+                    for i in columns:
+                        if i < len(row) and row[i]:
+                            number = int(row[i]) + offset
+                            row[i] = str(number)
+                            largest = max(largest, number)
+                    writer.writerow(row)
+            self.offsets[destination] = largest
+
+
+def merge_csv_files(sources, destination, renumber=True):
+    ''' Merge a list of csv files into one '''
+    merger = CSVMerger(renumber)
+    for source in sources:
+        merger.merge(source, destination)
+
+
+def unique_name(path):
+    ''' Add a number at the end of a file name to create a unique new name '''
+    stripped_name, suffix = os.path.splitext(path)
+    n = 2
+    new_name = stripped_name + '_' + str(n) + suffix
+    while os.path.exists(new_name):
+        n += 1
+        new_name = stripped_name + '_' + str(n) + suffix
+    return new_name
+
+
+def run_number(folder):
+    ''' Sort key placing run2 before run10 '''
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', folder)]
+
+
+def merge_result_folders(folders, destination, renumber=True):
+    ''' Merge the results folders of several runs into one folder.
+
+        csv files with the same name are merged in the order of the run
+        numbers, see CSVMerger. Other files are moved, with a number added
+        to the name if another run already wrote a file with the same name.
+    '''
+    merger = CSVMerger(renumber)
+    for folder in sorted(folders, key=run_number):
+        files = []
+        for root, dirs, names in os.walk(folder):
+            dirs.sort()
+            target_dir = os.path.join(destination, os.path.relpath(root, folder))
+            files += [(os.path.join(root, name), os.path.join(target_dir, name)) for name in sorted(names)]
+        merger.start_folder([target for path, target in files if target.endswith('.csv')])
+        for path, target in files:
+            target_dir = os.path.dirname(target)
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
+            if path.endswith('.csv'):
+                merger.merge(path, target)
+            else:
+                if os.path.exists(target):
+                    target = unique_name(target)
+                shutil.move(path, target)
+
+
+# Option of the command line for run folders numbering images in a shared list
+KEEP_IMAGE_NUMBERS = '--keep-image-numbers'
+
+if __name__ == '__main__':
+    # Run on the cluster as:
+    # python results.py [--keep-image-numbers] destination run0/results run1/results ...
+    args = sys.argv[1:]
+    renumber = KEEP_IMAGE_NUMBERS not in args
+    args = [a for a in args if a != KEEP_IMAGE_NUMBERS]
+    merge_result_folders(args[1:], args[0], renumber)
@@ -0,0 +1,140 @@
+"""
+A local cache of run metadata, so that ClusterView can show the runs
+without contacting the cluster and only needs to update runs that have
+not completed, and the run configurations on the cluster read in one
+command.
+"""
+
+import json
+import sqlite3
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# Runs in this state do not change on the cluster any more
+STATUS_COMPLETED = 'COMPLETED'
+STATUS_PENDING = 'PENDING'
+
+# The configuration Rynner saves in the folder of each run
+RUN_CONFIG = 'rynner.json'
+CONFIG_SEPARATOR = '==== '
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY,
+    job_name TEXT,
+    upload_time REAL,
+    status TEXT,
+    status_time REAL,
+    downloaded INTEGER,
+    downloads TEXT,
+    data TEXT
+)
+'''
+
+
+def is_finished(run):
+    ''' True if the status of the run can no longer change '''
+    return run.get('status') == STATUS_COMPLETED
+
+
+def with_defaults(run):
+    ''' Fill in the fields shown in ClusterView that a run only has once
+        its status has been read from the cluster, for example when it has
+        just been submitted '''
+    run.setdefault('status', STATUS_PENDING)
+    run.setdefault('status_time', run.get('upload_time') or 0)
+    run.setdefault('starttime', '')
+    return run
+
+
+def config_command(work_dir):
+    ''' A single command printing the configuration of each run in the
+        working directory, preceded by a separator line with its path '''
+    return 'for f in {}/*/{}; do [ -f "$f" ] && echo "{}$f" && cat "$f" && echo; done; true'.format(
+        quote(work_dir), RUN_CONFIG, CONFIG_SEPARATOR
+    )
+
+
+def parse_configs(output):
+    ''' Parse the output of config_command into a list of runs. Returns
+        None if any configuration cannot be read '''
+    configs = []
+    for line in output.splitlines():
+        if line.startswith(CONFIG_SEPARATOR):
+            configs.append([])
+        elif configs:
+            configs[-1].append(line)
+    try:
+        return [json.loads('\n'.join(lines)) for lines in configs]
+    except ValueError:
+        return None
+
+
+def read_runs(channel, work_dir):
+    ''' Read the configurations of all runs in the working directory in
+        one round trip. Returns None if they cannot all be read, for
+        example when the folder does not hold Rynner's json files '''
+    retcode, stdout, stderr = channel.execute_wait(config_command(work_dir), walltime=60)
+    if retcode != 0:
+        return None
+    runs = parse_configs(stdout)
+    if not runs:
+        return None
+    return runs
+
+
+class RunCache(object):
+    ''' Run descriptions stored in an SQLite database.
+
+        The fields shown in ClusterView have their own columns. The full
+        run description is kept as json. A connection is opened for each
+        call, so the cache can be used from several threads.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        db = self._connect()
+        try:
+            db.execute(SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def runs(self):
+        ''' All cached runs, newest first, see with_defaults '''
+        db = self._connect()
+        try:
+            rows = db.execute('SELECT data FROM runs ORDER BY upload_time DESC').fetchall()
+        finally:
+            db.close()
+        return [with_defaults(json.loads(row[0])) for row in rows]
+
+    def save(self, runs, replace=False):
+        ''' Store runs, replacing earlier versions of the same runs. With
+            replace, runs not in the list are removed from the cache '''
+        rows = [
+            (
+                run['id'],
+                run.get('job_name'),
+                run.get('upload_time'),
+                run.get('status'),
+                run.get('status_time'),
+                1 if run.get('downloaded') else 0,
+                json.dumps(run.get('downloads', [])),
+                json.dumps(run, default=str),
+            )
+            for run in runs
+        ]
+        db = self._connect()
+        try:
+            with db:
+                if replace:
+                    db.execute('DELETE FROM runs')
+                db.executemany('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        finally:
+            db.close()
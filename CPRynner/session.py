@@ -0,0 +1,112 @@
+"""
+An SSH session to the cluster that survives dropped connections.
+"""
+
+import threading
+import time
+
+
+def connection_errors():
+    ''' The errors caused by a lost connection. paramiko is only imported
+        once a connection has failed '''
+    errors = (EnvironmentError, EOFError)
+    try:
+        from paramiko import SSHException
+        errors += (SSHException,)
+    except ImportError:
+        pass
+    return errors
+
+
+def is_active(ssh_client):
+    ''' True if the connection of a paramiko SSHClient is still up '''
+    transport = ssh_client.get_transport()
+    return transport is not None and transport.is_active()
+
+
+def set_keepalive(ssh_client, interval):
+    ''' Send keepalive packets so that idle connections are not dropped by
+        firewalls and VPNs, and broken ones are noticed '''
+    transport = ssh_client.get_transport()
+    if transport is not None and interval > 0:
+        transport.set_keepalive(interval)
+
+
+class Session(object):
+    ''' A connection to the cluster that is opened again when it is lost.
+
+        connect is a function returning a connected paramiko SSHClient,
+        using cached credentials or the SSH agent. execute_wait has the
+        interface of the libsubmit channel and retries commands when the
+        connection fails, so it must only be used for commands that can be
+        safely run twice, such as listing files or querying the queue.
+    '''
+
+    def __init__(self, connect, keepalive=30, attempts=3, delay=2):
+        self.connect = connect
+        self.keepalive = keepalive
+        self.attempts = attempts
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.ssh_client = None
+        self.sftp = None
+
+    def client(self):
+        ''' The SSH client, reconnected if the connection was lost '''
+        with self.lock:
+            if self.ssh_client is None or not is_active(self.ssh_client):
+                self._reconnect()
+            return self.ssh_client
+
+    def _reconnect(self):
+        self._close()
+        self.ssh_client = self.connect()
+        set_keepalive(self.ssh_client, self.keepalive)
+
+    @property
+    def sftp_client(self):
+        client = self.client()
+        with self.lock:
+            if self.sftp is None:
+                self.sftp = client.open_sftp()
+            return self.sftp
+
+    def retry(self, operation):
+        ''' Call operation with the SSH client. If the connection fails, the
+            client is reconnected and operation is called again, waiting
+            longer after each failure '''
+        for attempt in range(self.attempts):
+            try:
+                return operation(self.client())
+            except connection_errors():
+                if attempt == self.attempts - 1:
+                    raise
+                with self.lock:
+                    self._close()
+                time.sleep(self.delay * 2**attempt)
+
+    def execute_wait(self, cmd, walltime=60):
+        ''' Run a command and return its exit status, stdout and stderr '''
+        def execute(ssh_client):
+            stdin, stdout, stderr = ssh_client.exec_command(cmd, timeout=walltime)
+            status = stdout.channel.recv_exit_status()
+            return status, stdout.read().decode('utf-8'), stderr.read().decode('utf-8')
+        return self.retry(execute)
+
+    def _close(self):
+        if self.sftp is not None:
+            try:
+                self.sftp.close()
+            except Exception:
+                pass
+            self.sftp = None
+        if self.ssh_client is not None:
+            try:
+                self.ssh_client.close()
+            except Exception:
+                pass
+            self.ssh_client = None
+
+    def close(self):
+        with self.lock:
+            self._close()
@@ -0,0 +1,234 @@
+"""
+Status of Slurm jobs, queried for many runs in a single command, and
+the node configurations of the partitions.
+"""
+
+import math
+import time
+
+from .planning import worker_concurrency
+
+# Slurm states of jobs that have not finished yet
+ACTIVE_STATES = set([
+    'PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'SUSPENDED',
+    'REQUEUED', 'REQUEUE_FED', 'REQUEUE_HOLD', 'RESIZING', 'SIGNALING',
+    'STAGE_OUT', 'STOPPED',
+])
+
+# Statuses shown in ClusterView
+STATUS_PENDING = 'PENDING'
+STATUS_COMPLETED = 'COMPLETED'
+
+SEPARATOR = '----'
+
+# Node configurations of the partitions: name, cores and memory in MB per
+# node, time limit, node counts as allocated/idle/other/total, availability
+PARTITION_COMMAND = "sinfo -h -e -o '%P|%c|%m|%l|%F|%a'"
+
+
+def base_job_id(job_id):
+    ''' The job id without array task or job step, 123_4.0 -> 123 '''
+    return job_id.split('_')[0].split('.')[0]
+
+
+def parse_time(text):
+    ''' Seconds since the epoch from a Slurm time stamp, None if not set '''
+    try:
+        return time.mktime(time.strptime(text, '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+
+def combined_state(states):
+    ''' The state of a job from the states of its array tasks. The job is
+        active while any task is, and completed only if all tasks are '''
+    for state in ['RUNNING', 'PENDING']:
+        if state in states:
+            return state
+    for state in states:
+        if state in ACTIVE_STATES:
+            return state
+    for state in states:
+        if state != 'COMPLETED':
+            return state
+    return 'COMPLETED'
+
+
+def parse_job_states(output):
+    ''' Parse the output of the command from status_command into a dict
+        of job states by job id. Each entry holds the raw Slurm 'state',
+        the 'status' shown in ClusterView, the 'status_time' of the last
+        change and the estimated 'starttime' of pending jobs '''
+    queue_output, _, accounting_output = output.partition(SEPARATOR + '\n')
+    tasks = {}
+    jobs = {}
+
+    # The accounting database knows about finished jobs
+    for line in accounting_output.splitlines():
+        parts = line.strip().split('|')
+        if len(parts) < 5:
+            continue
+        job_id, state, submit, start, end = parts[:5]
+        job_id = base_job_id(job_id)
+        # CANCELLED by 1234 -> CANCELLED
+        tasks.setdefault(job_id, []).append(state.split(' ')[0])
+        job = jobs.setdefault(job_id, {'starttime': '', 'times': []})
+        job['times'] += [t for t in (parse_time(submit), parse_time(start), parse_time(end)) if t is not None]
+
+    # The queue is more up to date for jobs that have not finished
+    queued = {}
+    for line in queue_output.splitlines():
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        job_id = base_job_id(parts[0])
+        queued.setdefault(job_id, []).append(parts[1])
+        job = jobs.setdefault(job_id, {'starttime': '', 'times': []})
+        if len(parts) > 2 and parts[2] not in ('N/A', 'Unknown'):
+            job['starttime'] = parts[2]
+    tasks.update(queued)
+
+    states = {}
+    for job_id, job in jobs.items():
+        state = combined_state(tasks[job_id])
+        states[job_id] = {
+            'state': state,
+            'status': STATUS_PENDING if state in ACTIVE_STATES else STATUS_COMPLETED,
+            'status_time': max(job['times']) if job['times'] else None,
+            'starttime': job['starttime'],
+        }
+    return states
+
+
+def status_command(job_ids):
+    ''' A single command listing the queued jobs of the user and the
+        accounting records of the given jobs '''
+    return (
+        "squeue -h -u $USER -o '%i %T %S' 2>/dev/null; echo {}; "
+        "sacct -n -X -P -o JobID,State,Submit,Start,End -j {} 2>/dev/null"
+    ).format(SEPARATOR, ','.join(sorted(set(job_ids))))
+
+
+def query_job_states(channel, job_ids):
+    ''' The states of a list of jobs, see parse_job_states. None if the
+        query failed, which includes sacct failing, as the command ends
+        with it '''
+    job_ids = [str(j) for j in job_ids if j]
+    if len(job_ids) == 0:
+        return {}
+    retcode, stdout, stderr = channel.execute_wait(status_command(job_ids), walltime=60)
+    if retcode != 0 or SEPARATOR not in stdout:
+        return None
+    return parse_job_states(stdout)
+
+
+def update_runs(channel, runs):
+    ''' Update the status of a list of runs in one round trip. Runs whose
+        job is neither queued nor in the accounting database have finished
+        and are marked completed. If the query fails, the runs are left
+        as they are '''
+    states = query_job_states(channel, [run.get('qid') for run in runs])
+    if states is None:
+        return runs
+    for run in runs:
+        if not run.get('qid'):
+            continue
+        job = states.get(str(run['qid']))
+        if job is None:
+            run['status'] = STATUS_COMPLETED
+            run['slurm_state'] = 'UNKNOWN'
+            continue
+        run['status'] = job['status']
+        run['slurm_state'] = job['state']
+        run['starttime'] = job['starttime']
+        if job['status_time'] is not None:
+            run['status_time'] = job['status_time']
+    return runs
+
+
+def parse_count(text):
+    ''' A number from sinfo, which marks varying values with a + '''
+    try:
+        return int(text.rstrip('+'))
+    except ValueError:
+        return 0
+
+
+def parse_time_limit(text):
+    ''' Hours from a Slurm time limit such as 2-00:00:00, 12:00:00 or 30:00.
+        None if there is no limit '''
+    if text in ('infinite', 'UNLIMITED', 'NONE', 'n/a', ''):
+        return None
+    days, _, clock = text.rpartition('-')
+    seconds = 0
+    for part, unit in zip(reversed(clock.split(':')), [1, 60, 3600]):
+        seconds += int(part)*unit
+    return int(days or 0)*24 + seconds/3600.0
+
+
+def parse_partitions(output):
+    ''' Parse the output of PARTITION_COMMAND into a list of partitions
+        that are up. Partitions with different kinds of nodes are listed
+        once per kind. Each entry holds the 'name', whether it is the
+        'default' partition, the 'cpus' and 'memory' in GB per node, the
+        'time_limit' in hours and the number of 'idle' and all 'nodes' '''
+    partitions = []
+    for line in output.splitlines():
+        parts = line.strip().split('|')
+        if len(parts) < 6 or parts[5] != 'up':
+            continue
+        name, cpus, memory, limit, counts = parts[:5]
+        counts = counts.split('/')
+        if len(counts) != 4:
+            continue
+        partitions.append({
+            'name': name.rstrip('*'),
+            'default': name.endswith('*'),
+            'cpus': parse_count(cpus),
+            'memory': parse_count(memory) // 1024,
+            'time_limit': parse_time_limit(limit),
+            'idle': parse_count(counts[1]),
+            'nodes': parse_count(counts[3]),
+        })
+    return partitions
+
+
+def query_partitions(channel):
+    ''' The partitions of the cluster, see parse_partitions. Empty if sinfo
+        fails '''
+    retcode, stdout, stderr = channel.execute_wait(PARTITION_COMMAND, walltime=60)
+    if retcode != 0:
+        return []
+    return parse_partitions(stdout)
+
+
+def choose_partition(partitions, n_measurements, walltime, n_nodes=1,
+                     task_memory=0, name=''):
+    ''' The partition to process n_measurements on, None if none fits.
+
+        Only partitions with at least n_nodes nodes and a time limit of at
+        least walltime hours are considered, and only those called name if
+        it is given. Runs that fit on idle nodes do not wait in the queue,
+        so these are preferred. Among them, the one that processes the batch
+        in the fewest rounds of CellProfiler processes is chosen, and then
+        the one with the most cores per node.
+    '''
+    def cost(partition):
+        concurrency = worker_concurrency(partition['cpus'], partition['memory'], task_memory)
+        rounds = math.ceil(n_measurements / float(concurrency*n_nodes))
+        return (
+            partition['idle'] < n_nodes,
+            rounds,
+            -partition['cpus'],
+            not partition['default'],
+        )
+
+    candidates = [
+        p for p in partitions
+        if p['cpus'] > 0 and p['nodes'] >= n_nodes
+        and (p['time_limit'] is None or p['time_limit'] >= walltime)
+        and (not name or p['name'] == name)
+    ]
+    if len(candidates) == 0:
+        return None
+    return min(candidates, key=cost)
@@ -0,0 +1,498 @@
+"""
+Helpers for moving files between the local machine and the cluster.
+"""
+
+import hashlib
+import heapq
+import io
+import json
+import os
+import posixpath
+import shutil
+import tarfile
+import threading
+import time
+import uuid
+
+from .session import connection_errors
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+def archive_name(compress=False):
+    ''' The file name used for upload archives '''
+    if compress:
+        return 'images.tar.gz'
+    return 'images.tar'
+
+
+def pack_archive(archive_path, members, compress=False, callback=None):
+    ''' Write a list of (local_path, name_in_archive) pairs into a tar archive.
+
+        The archive is written as a stream, so each file is read once and
+        nothing is held in memory. callback is called with the number of
+        files packed so far.
+    '''
+    mode = 'w|gz' if compress else 'w|'
+    with open(archive_path, 'wb') as outfile:
+        tar = tarfile.open(fileobj=outfile, mode=mode)
+        try:
+            for n, (path, arcname) in enumerate(members):
+                tar.add(path, arcname=arcname, recursive=False)
+                if callback is not None:
+                    callback(n + 1)
+        finally:
+            tar.close()
+    return archive_path
+
+
+def file_digest(path, block_size=1<<20):
+    ''' The sha1 hash of a file's contents '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        block = infile.read(block_size)
+        while block:
+            digest.update(block)
+            block = infile.read(block_size)
+    return digest.hexdigest()
+
+
+class UploadManifest(object):
+    ''' A local record of file paths, sizes, modification times and content hashes.
+
+        Hashes are only recomputed when the size or modification time of a
+        file has changed.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as infile:
+                    self.entries = json.load(infile)
+            except ValueError:
+                # A corrupt manifest only costs rehashing
+                self.entries = {}
+
+    def digest(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            return entry[2]
+        digest = file_digest(path)
+        self.entries[path] = [stat.st_size, stat.st_mtime, digest]
+        return digest
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(self.entries, outfile)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+
+def list_remote_dir(channel, path):
+    ''' Return the set of file names in a remote directory, empty if it does not exist '''
+    retcode, stdout, stderr = channel.execute_wait(
+        "ls -1 {} 2>/dev/null".format(quote(path)), walltime=60
+    )
+    return set(stdout.split())
+
+
+def cache_uploads(uploads, manifest, cache_dir, cached, callback=None):
+    ''' Split uploads into files missing from the cluster cache and a shell
+        script for linking files between the cache and the run folders.
+
+        uploads is a list of [local_path, remote_folder] pairs and cached the set
+        of hashes already in cache_dir. Returns the remaining uploads and the
+        script. The script links cached files into place and stores newly
+        uploaded files in the cache. callback is called with the number of
+        files hashed so far.
+    '''
+    remaining = []
+    folders = set()
+    lines = []
+    for n, (path, folder) in enumerate(uploads):
+        digest = manifest.digest(path)
+        if callback is not None:
+            callback(n + 1)
+        target = quote(folder + '/' + os.path.basename(path))
+        cache_object = quote(cache_dir + '/' + digest)
+        folders.add(quote(folder))
+        if digest in cached:
+            lines.append('ln -f {0} {1} 2>/dev/null || cp {0} {1}'.format(cache_object, target))
+        else:
+            remaining.append([path, folder])
+            lines.append('ln -f {0} {1} 2>/dev/null || cp {0} {1}'.format(target, cache_object))
+            cached.add(digest)
+
+    script = ['mkdir -p {}'.format(quote(cache_dir))]
+    script += ['mkdir -p {}'.format(f) for f in sorted(folders)]
+    script += lines
+    return remaining, '\n'.join(script) + '\n'
+
+
+# Download filter for measurement files only
+MEASUREMENT_PATTERNS = ['*.csv', '*.h5', '*.hdf5']
+
+
+def find_command(folders, patterns=None):
+    ''' A find command listing the files under folders, limited to names
+        matching one of the glob patterns if given. Without folders, find
+        would list the whole directory, so an empty list is refused '''
+    if len(folders) == 0:
+        raise ValueError("No folders to list")
+    command = 'find {} -type f'.format(' '.join(quote(f) for f in folders))
+    if patterns:
+        command += ' \\( {} \\)'.format(' -o '.join('-name ' + quote(p) for p in patterns))
+    return command
+
+
+def list_remote_files(channel, root, folders, patterns=None):
+    ''' List the files under the given folders of a remote directory in a
+        single command. Returns (relative path, size) pairs '''
+    retcode, stdout, stderr = channel.execute_wait(
+        "cd {} && {} -printf '%s %p\\n'".format(quote(root), find_command(folders, patterns)),
+        walltime=60
+    )
+    files = []
+    for line in stdout.splitlines():
+        size, path = line.split(' ', 1)
+        files.append((posixpath.normpath(path), int(size)))
+    return files
+
+
+def split_files(files, n_parts):
+    ''' Split (path, size) pairs into at most n_parts lists of paths with
+        roughly equal total size, each sorted by path '''
+    parts = [(0, k, []) for k in range(min(n_parts, len(files)))]
+    for path, size in sorted(files, key=lambda f: -f[1]):
+        total, k, paths = heapq.heappop(parts)
+        paths.append(path)
+        heapq.heappush(parts, (total + size, k, paths))
+    return [sorted(paths) for total, k, paths in sorted(parts, key=lambda p: p[1])]
+
+
+def extract_stream(stream, local_dir, callback=None):
+    ''' Extract the regular files of a tar stream into local_dir. Members
+        outside local_dir are skipped. callback is called with the size of
+        each extracted file '''
+    tar = tarfile.open(fileobj=stream, mode='r|*')
+    try:
+        for member in tar:
+            path = posixpath.normpath(member.name)
+            if not member.isfile() or path.startswith('..') or posixpath.isabs(path):
+                continue
+            local_path = os.path.join(local_dir, *path.split('/'))
+            folder = os.path.dirname(local_path)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            infile = tar.extractfile(member)
+            with open(local_path, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile)
+            if callback is not None:
+                callback(member.size)
+    finally:
+        tar.close()
+
+
+class HashingReader(object):
+    ''' Wraps a file object and computes the sha1 hash of everything read '''
+
+    def __init__(self, infile):
+        self.infile = infile
+        self.digest = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.infile.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+class TransferManifest(object):
+    ''' Records which files of a run have finished uploading, with their sizes
+        and checksums, so that an interrupted upload can be resumed.
+
+        The manifest is kept as a json file locally, together with the run
+        description, and as lines of "checksum size path" in the run folder
+        on the cluster. Paths are relative to the run folder. The size and
+        modification time of the local files are kept in sources, so that
+        an upload is not resumed with files that have changed.
+    '''
+
+    remote_name = '.transfer_manifest'
+
+    def __init__(self, path, run=None):
+        self.path = path
+        self.run = run
+        self.done = {}
+        self.sources = {}
+        self.new_lines = []
+        if os.path.isfile(path):
+            with open(path, 'r') as infile:
+                data = json.load(infile)
+            self.run = data['run']
+            self.done = data['done']
+            self.sources = data.get('sources', {})
+
+    def record_sources(self, paths):
+        ''' Remember the size and modification time of the local files '''
+        for path in paths:
+            stat = os.stat(path)
+            self.sources[path] = [stat.st_size, stat.st_mtime]
+
+    def changed_sources(self):
+        ''' The local files that changed or were removed since they were recorded '''
+        changed = []
+        for path, (size, mtime) in sorted(self.sources.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                changed.append(path)
+                continue
+            if stat.st_size != size or stat.st_mtime != mtime:
+                changed.append(path)
+        return changed
+
+    def mark_done(self, path, size, checksum):
+        self.done[path] = [size, checksum]
+        self.new_lines.append('{} {} {}\n'.format(checksum, size, path))
+
+    def is_done(self, path, local_path):
+        entry = self.done.get(path)
+        return entry is not None and entry[0] == os.path.getsize(local_path)
+
+    def verify(self, remote_lines, remote_sizes):
+        ''' Keep only files that the cluster manifest confirms with the same
+            checksum and that have the recorded size on the cluster '''
+        confirmed = {}
+        for line in remote_lines:
+            parts = line.strip().split(' ', 2)
+            if len(parts) == 3:
+                confirmed[parts[2]] = parts[0]
+        self.done = dict(
+            (path, entry) for path, entry in self.done.items()
+            if confirmed.get(path) == entry[1] and remote_sizes.get(path) == entry[0]
+        )
+
+    def pop_new_lines(self):
+        lines = self.new_lines
+        self.new_lines = []
+        return ''.join(lines)
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump({'run': self.run, 'done': self.done, 'sources': self.sources}, outfile)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class TransferPool(object):
+    ''' Runs file transfers concurrently over a pool of SFTP connections.
+
+        connect is a function returning a connected paramiko SSHClient. The
+        connections are opened when first needed and kept until close() is
+        called. Transfers run in background threads; progress() reports the
+        fraction of bytes transferred so that the caller can update a dialog.
+        A file whose transfer fails because the connection was lost is
+        transferred again over a new connection, up to retries times.
+    '''
+
+    def __init__(self, connect, size=4, retries=3, retry_delay=2):
+        self.connect = connect
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.size = max(1, int(size))
+        self.clients = [None]*self.size
+        self.lock = threading.Lock()
+        self.threads = []
+        self.total = 0
+        self.transferred = 0
+        self.errors = []
+        self.completed = []
+        self.cancelled = False
+
+    def _sftp(self, index):
+        if self.clients[index] is None:
+            ssh_client = self.connect()
+            self.clients[index] = (ssh_client, ssh_client.open_sftp())
+        return self.clients[index][1]
+
+    def _ssh_client(self, sftp):
+        # The SSH connection an SFTP connection of the pool runs over
+        return next(c[0] for c in self.clients if c is not None and c[1] is sftp)
+
+    def _drop_client(self, index):
+        if self.clients[index] is not None:
+            ssh_client, sftp = self.clients[index]
+            self.clients[index] = None
+            for connection in (sftp, ssh_client):
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+    def _transfer(self, index, job, transfer):
+        for attempt in range(self.retries + 1):
+            try:
+                return transfer(self._sftp(index), job)
+            except connection_errors():
+                if attempt == self.retries or self.cancelled:
+                    raise
+                self._drop_client(index)
+                time.sleep(self.retry_delay * 2**attempt)
+
+    def _execute(self, cmd):
+        ssh_client = self.clients[0][0] if self.clients[0] is not None else None
+        if ssh_client is None:
+            self._sftp(0)
+            ssh_client = self.clients[0][0]
+        stdin, stdout, stderr = ssh_client.exec_command(cmd)
+        return stdout.channel.recv_exit_status()
+
+    def _add_progress(self, n_bytes):
+        with self.lock:
+            self.transferred += n_bytes
+
+    def _worker(self, index, jobs, transfer):
+        try:
+            while True:
+                with self.lock:
+                    if len(jobs) == 0 or self.errors or self.cancelled:
+                        return
+                    job = jobs.pop()
+                self._transfer(index, job, transfer)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+
+    def _start(self, jobs, transfer):
+        if not self.finished():
+            raise RuntimeError("A transfer is already running")
+        jobs = list(reversed(jobs))
+        self.errors = []
+        self.completed = []
+        self.cancelled = False
+        self.transferred = 0
+        self.threads = [
+            threading.Thread(target=self._worker, args=(i, jobs, transfer))
+            for i in range(min(self.size, max(1, len(jobs))))
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _progress_callback(self):
+        # Report progress from paramiko callbacks as increments
+        state = {'done': 0}
+        def callback(done, total):
+            self._add_progress(done - state['done'])
+            state['done'] = done
+        return callback
+
+    def start_upload(self, files):
+        ''' Upload (local path, remote path) pairs. Remote folders are created first.
+            Finished files are recorded with their size and sha1 checksum, see
+            pop_completed() '''
+        folders = set(posixpath.dirname(remote) for local, remote in files)
+        if folders:
+            self._execute('mkdir -p ' + ' '.join(quote(f) for f in sorted(folders)))
+        self.total = sum(os.path.getsize(local) for local, remote in files)
+
+        def upload(sftp, job):
+            local, remote = job
+            size = os.path.getsize(local)
+            with open(local, 'rb') as infile:
+                reader = HashingReader(infile)
+                sftp.putfo(reader, remote, size, self._progress_callback())
+            # Scripts need to be executable on the cluster
+            sftp.chmod(remote, 0o755)
+            with self.lock:
+                self.completed.append((local, remote, size, reader.hexdigest()))
+        self._start(files, upload)
+
+    def start_archive_download(self, root, files, local_dir):
+        ''' Download (relative path, size) pairs from the remote directory
+            root, extracting into local_dir while receiving. The files are
+            split between the connections, each streaming its share as a
+            compressed tar archive. The file list of each stream is written
+            to the cluster first, as it can be longer than a command line '''
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        self.total = sum(size for path, size in files)
+
+        def download(sftp, paths):
+            ssh_client = self._ssh_client(sftp)
+            file_list = posixpath.join(root, '.download_' + uuid.uuid4().hex)
+            listing = ''.join(path + '\0' for path in paths).encode('utf-8')
+            sftp.putfo(io.BytesIO(listing), file_list, len(listing))
+            stdin, stdout, stderr = ssh_client.exec_command(
+                'cd {} && tar -czf - --null -T {}; status=$?; rm -f {}; exit $status'.format(
+                    quote(root), quote(file_list), quote(file_list)
+                )
+            )
+            # A retried stream starts again from the beginning
+            received = [0]
+            def callback(n_bytes):
+                received[0] += n_bytes
+                self._add_progress(n_bytes)
+            try:
+                extract_stream(stdout, local_dir, callback)
+                if stdout.channel.recv_exit_status() != 0:
+                    raise IOError("Downloading from {} failed".format(root))
+            except Exception:
+                self._add_progress(-received[0])
+                raise
+        self._start(split_files(files, self.size), download)
+
+    def pop_completed(self):
+        ''' Return and forget the uploads finished since the last call '''
+        with self.lock:
+            completed = self.completed
+            self.completed = []
+        return completed
+
+    def cancel(self):
+        ''' Stop after the files currently in transfer '''
+        self.cancelled = True
+
+    def progress(self):
+        ''' The fraction of bytes transferred '''
+        if self.total == 0:
+            return 1.0 if self.finished() else 0.0
+        return min(1.0, float(self.transferred)/self.total)
+
+    def finished(self):
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def wait(self):
+        ''' Wait for the transfers to finish and raise the first error '''
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def close(self):
+        for client in self.clients:
+            if client is not None:
+                client[1].close()
+                client[0].close()
+        self.clients = [None]*self.size
@@ -23,16 +23,29 @@ import logging
 logger = logging.getLogger(__package__)
 
 import numpy as np
-import os, time, shutil
+import os, time, shutil, posixpath
 import tempfile
 import timeago, datetime
 import wx
+import wx.lib.dialogs
 
 import cellprofiler.module as cpm
 import cellprofiler.setting as cps
 import cellprofiler.preferences as cpprefs
 
 import CPRynner.CPRynner as CPRynner
+from CPRynner.transfer import list_remote_files, MEASUREMENT_PATTERNS
+from CPRynner.results import CSVMerger, run_number
+from CPRynner.planning import FINISHED_FOLDER, MERGE_FOLDER, CHUNK_FOLDER, chunk_folder
+from CPRynner.polling import Poller
+from CPRynner.runcache import is_finished, with_defaults
+from CPRynner.progress import format_progress
+
+
+# Choices of files to download
+D_ALL = "All result files"
+D_MEASUREMENTS = "Measurements only (csv and HDF5 files)"
+D_PATTERN = "Files matching a pattern"
 
 
 class YesToAllMessageDialog(wx.Dialog):
@@ -87,19 +100,120 @@ class YesToAllMessageDialog(wx.Dialog):
         self.Destroy()
 
 
+# Filters of the run list
+F_ALL = "All runs"
+STATUS_FILTERS = [F_ALL, 'PENDING', 'COMPLETED']
+AGE_FILTERS = [
+    ("Any time", None),
+    ("Last day", 24*3600),
+    ("Last week", 7*24*3600),
+    ("Last month", 31*24*3600),
+]
+
+# Columns of the run list, with widths
+RUN_COLUMNS = [
+    ("Run", 150),
+    ("Status", 110),
+    ("Since", 140),
+    ("Estimated start", 140),
+    ("Progress", 170),
+    ("Downloaded", 80),
+]
+
+
+def run_row(run):
+    '''
+    The texts shown for a run in the run list
+    '''
+    status = run.status
+    if run.get('slurm_state') and run['slurm_state'] != status:
+        status += ' (' + run['slurm_state'] + ')'
+    since = str(datetime.datetime.fromtimestamp(int(run['status_time'])))
+    starttime = run['starttime'] if run.status == 'PENDING' else ''
+    progress = format_progress(run['progress']) if run.get('progress') else ''
+    if run.get('downloaded'):
+        downloaded = 'Yes'
+    elif run.get('downloaded_groups'):
+        downloaded = 'Partly'
+    else:
+        downloaded = ''
+    return [run.job_name, status, since, starttime, progress, downloaded]
+
+
+def run_folders(run):
+    '''
+    The run folders of a run that can be downloaded one at a time. The
+    chunks of a dynamic run are downloaded from a single folder, so their
+    run folders are listed from the number of chunks
+    '''
+    folders = [d[0] for d in run.downloads]
+    if folders == [CHUNK_FOLDER]:
+        return [chunk_folder(k) for k in range(run.get('chunks', 0))]
+    return folders
+
+
+def results_folders(directory, folders):
+    '''
+    The results folders of the given run folders downloaded into directory,
+    in run folder order. A whole chunk folder holds a run folder per chunk
+    '''
+    results = []
+    for folder in folders:
+        path = os.path.join(directory, folder)
+        if folder == CHUNK_FOLDER and os.path.isdir(path):
+            results += [os.path.join(path, name, 'results') for name in sorted(os.listdir(path), key=run_number)]
+        else:
+            results.append(os.path.join(path, 'results'))
+    # Folders without results matched nothing in the download filter
+    return [path for path in results if os.path.isdir(path)]
+
+
+class RunListCtrl(wx.ListCtrl):
+    '''
+    A list of runs that only draws the visible rows
+    '''
+
+    def __init__(self, parent, frame):
+        super(RunListCtrl, self).__init__(parent, size=(-1, 250),
+            style=wx.LC_REPORT|wx.LC_VIRTUAL|wx.LC_SINGLE_SEL)
+        self.frame = frame
+        for index, (label, width) in enumerate(RUN_COLUMNS):
+            self.InsertColumn(index, label, width=width)
+
+    def OnGetItemText(self, item, column):
+        return run_row(self.frame.visible_runs[item])[column]
+
+
 class ClusterviewFrame(wx.Frame):
     '''
-    A frame containing information on queued and accomplished runs,
-    update and logout buttons and a download button for each run
+    A frame containing a list of queued and accomplished runs, update
+    and logout buttons and download buttons for the selected run
     '''
 
     def __init__(self, parent, title):
-        # First update runs, then create the window
-        super(ClusterviewFrame, self).__init__(parent, title=title, size = (400,400))
+        # Create the window showing the cached runs and update them in the background
+        super(ClusterviewFrame, self).__init__(parent, title=title, size = (810,520))
         self.update_time = datetime.datetime.now()
-        self.update()
+        self.runs = CPRynner.cached_runs()
+        self.pending_uploads = CPRynner.pending_uploads()
+        self.full_update = False
+        # The connection the background updates use, taken on the GUI thread
+        self.connection = None
+        self.visible_runs = []
+        self.status_filter_index = 0
+        self.age_filter_index = 0
+        self.busy = False
+        self.poller = Poller(
+            self.fetch_runs,
+            lambda runs: wx.CallAfter(self.on_runs_fetched, runs),
+            60*CPRynner.cluster_refresh_interval(),
+            on_error = lambda e: wx.CallAfter(self.on_fetch_failed, e)
+        )
         self.InitUI()
         self.Centre()
+        self.poller.start()
+        # Log in once the cached runs are shown
+        wx.CallAfter(self.update, len(self.runs) == 0)
 
     def InitUI(self):
         # The containers in the window are organised here
@@ -154,76 +268,258 @@ class ClusterviewFrame(wx.Frame):
         line = wx.StaticLine(self.panel)
         vbox.Add(line, 0, wx.EXPAND, 10)
 
-        # Add a display for all runs in history
-        self.run_displays = []
-        for run in sorted(self.runs, key=lambda k: k['upload_time'], reverse = True):
-            # Run name
+        # Uploads that were interrupted before submission, in a sizer of
+        # their own so that they can be refreshed without the rest
+        self.uploads_box = wx.BoxSizer(wx.VERTICAL)
+        vbox.Add(self.uploads_box, 0, wx.EXPAND)
+        self.build_pending_uploads()
+
+        # Filters for the run list
+        self.status_filter = wx.Choice(self.panel, choices=STATUS_FILTERS)
+        self.status_filter.SetSelection(self.status_filter_index)
+        self.status_filter.Bind(wx.EVT_CHOICE, self.on_filter_change)
+        self.age_filter = wx.Choice(self.panel, choices=[a[0] for a in AGE_FILTERS])
+        self.age_filter.SetSelection(self.age_filter_index)
+        self.age_filter.Bind(wx.EVT_CHOICE, self.on_filter_change)
+        hbox = wx.BoxSizer(wx.HORIZONTAL)
+        hbox.Add(wx.StaticText(self.panel, label="Show:"), 0, wx.LEFT|wx.ALIGN_CENTER_VERTICAL, 8)
+        hbox.Add(self.status_filter, 0, wx.LEFT|wx.ALIGN_CENTER_VERTICAL, 8)
+        hbox.Add(self.age_filter, 0, wx.LEFT|wx.ALIGN_CENTER_VERTICAL, 8)
+        vbox.Add(hbox, 0, wx.TOP, 8)
+
+        # All runs in history. The list only draws the visible rows and is
+        # updated in place when the runs are updated
+        self.run_list = RunListCtrl(self.panel, self)
+        self.run_list.Bind(wx.EVT_LIST_ITEM_SELECTED, lambda e: self.update_run_buttons())
+        self.run_list.Bind(wx.EVT_LIST_ITEM_DESELECTED, lambda e: self.update_run_buttons())
+        self.run_list.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.on_run_activated)
+        vbox.Add(self.run_list, 1, wx.EXPAND|wx.ALL, 8)
+
+        # The download buttons act on the selected run
+        self.progress_btn = wx.Button(self.panel, label='Show Progress', size=(130, 40))
+        self.progress_btn.Bind(wx.EVT_BUTTON, lambda e: self.on_progress_click( e, self.selected_run() ) )
+        self.download_btn = wx.Button(self.panel, label='Download Results', size=(130, 40))
+        self.download_btn.Bind(wx.EVT_BUTTON, lambda e: self.on_download_click( e, self.selected_run() ) )
+        self.download_finished_btn = wx.Button(self.panel, label='Download Finished', size=(150, 40))
+        self.download_finished_btn.Bind(wx.EVT_BUTTON, lambda e: self.on_download_finished_click( e, self.selected_run() ) )
+        hbox = wx.BoxSizer(wx.HORIZONTAL)
+        hbox.Add(self.progress_btn, 0, wx.RIGHT, 8)
+        hbox.Add(self.download_finished_btn, 0, wx.RIGHT, 8)
+        hbox.Add(self.download_btn)
+        vbox.Add(hbox, flag=wx.ALIGN_RIGHT|wx.RIGHT|wx.BOTTOM, border=10)
+
+        self.refresh_run_list()
+
+    def build_pending_uploads(self):
+        '''
+        Add a display for each upload that was interrupted before submission
+        '''
+        font = wx.SystemSettings.GetFont(wx.SYS_SYSTEM_FONT)
+        font.SetPointSize(9)
+        vbox = self.uploads_box
+        for run in self.pending_uploads:
             st = wx.StaticText(self.panel, label=run.job_name+":")
             st.SetFont(font)
             hbox1 = wx.BoxSizer(wx.HORIZONTAL)
             hbox1.Add(st, flag=wx.RIGHT, border=8)
             vbox.Add(hbox1, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP)
 
-            # The state of the run
             hbox2 = wx.BoxSizer(wx.HORIZONTAL)
-            time_since = str(datetime.datetime.fromtimestamp(int(run['status_time'])))
-            st2 = wx.StaticText( self.panel,
-                label=run.status+" since " + time_since
-            )
+            st2 = wx.StaticText(self.panel, label="Upload incomplete, not submitted")
             hbox2.Add(st2)
             vbox.Add(hbox2, flag=wx.LEFT | wx.TOP, border=10)
+            vbox.Add((-1, 5))
 
-            if run.status == 'PENDING':
-                starttime = run['starttime']
-                hbox3 = wx.BoxSizer(wx.HORIZONTAL)
-                st3 = wx.StaticText( self.panel,
-                    label="Estimated start time " + starttime
-                )
-                hbox3.Add(st3)
-                vbox.Add(hbox3, flag=wx.LEFT | wx.TOP, border=10)
+            resume_btn = wx.Button(self.panel, label='Resume Upload', size=(130, 40))
+            resume_btn.Bind(wx.EVT_BUTTON, lambda e, r=run: self.on_resume_upload_click( e, r ) )
+            discard_btn = wx.Button(self.panel, label='Discard', size=(90, 40))
+            discard_btn.Bind(wx.EVT_BUTTON, lambda e, r=run: self.on_discard_upload_click( e, r ) )
+            hbox3 = wx.BoxSizer(wx.HORIZONTAL)
+            hbox3.Add(discard_btn, 0, wx.RIGHT, 8)
+            hbox3.Add(resume_btn)
+            vbox.Add(hbox3, flag=wx.ALIGN_RIGHT|wx.RIGHT, border=10)
 
-            # Padding
-            vbox.Add((-1, 5))
+    def refresh_pending_uploads(self):
+        '''
+        Rebuild the display of the pending uploads only
+        '''
+        self.uploads_box.Clear(True)
+        self.build_pending_uploads()
+        self.vbox.Layout()
+        self.FitInside()
 
-            # The download button
-            if run.status == 'COMPLETED':
-                if hasattr(run, 'downloaded') and run.downloaded:
-                    label = 'Download Again'
-                else:
-                    label = 'Download Results'
-                btn = wx.Button(self.panel, label=label, size=(130, 40))
-                btn.Bind(wx.EVT_BUTTON, lambda e, r=run: self.on_download_click( e, r ) )
-                hbox3 = wx.BoxSizer(wx.HORIZONTAL)
-                hbox3.Add(btn)
-                vbox.Add(hbox3, flag=wx.ALIGN_RIGHT|wx.RIGHT, border=10)
+    def refresh(self):
+        '''
+        Show the current pending uploads and runs
+        '''
+        self.refresh_pending_uploads()
+        self.refresh_run_list()
+
+    def filter_runs(self):
+        '''
+        The runs matching the status and age filters, newest first
+        '''
+        status = STATUS_FILTERS[self.status_filter_index]
+        max_age = AGE_FILTERS[self.age_filter_index][1]
+        now = time.time()
+        runs = [
+            run for run in self.runs
+            if (status == F_ALL or run.status == status)
+            and (max_age is None or now - run['upload_time'] < max_age)
+        ]
+        return sorted(runs, key=lambda k: k['upload_time'], reverse = True)
+
+    def refresh_run_list(self):
+        '''
+        Update the rows of the run list in place, keeping the selection
+        '''
+        selected = self.selected_run()
+        self.visible_runs = self.filter_runs()
+        self.run_list.SetItemCount(len(self.visible_runs))
+        if selected is not None:
+            for index, run in enumerate(self.visible_runs):
+                if run['id'] == selected['id']:
+                    self.run_list.Select(index)
+                    break
+        if len(self.visible_runs) > 0:
+            self.run_list.RefreshItems(0, len(self.visible_runs)-1)
+        self.update_run_buttons()
+
+    def selected_run(self):
+        index = self.run_list.GetFirstSelected()
+        if index < 0 or index >= len(self.visible_runs):
+            return None
+        return self.visible_runs[index]
+
+    def update_run_buttons(self):
+        '''
+        Enable the download buttons that apply to the selected run
+        '''
+        run = self.selected_run()
+        completed = run is not None and run.status == 'COMPLETED'
+        if completed and run.get('downloaded'):
+            self.download_btn.SetLabel('Download Again')
+        else:
+            self.download_btn.SetLabel('Download Results')
+        self.download_btn.Enable(completed)
+        self.progress_btn.Enable(run is not None and bool(run.get('progress')))
+        # Results of finished run folders can be fetched while the run is going
+        self.download_finished_btn.Enable(
+            run is not None and not completed and len(run.downloads) > 0
+            and run.downloads[0][0] != MERGE_FOLDER
+        )
+
+    def on_filter_change(self, event):
+        self.status_filter_index = self.status_filter.GetSelection()
+        self.age_filter_index = self.age_filter.GetSelection()
+        self.refresh_run_list()
+
+    def on_run_activated(self, event):
+        run = self.selected_run()
+        if run is not None and run.status == 'COMPLETED':
+            self.on_download_click(event, run)
 
     def set_timer(self, element):
         '''
         Set a timer to update the time since last update
         '''
+        self.update_time_text = element
         def update_st(event):
-            element.SetLabel("Last updated: "+timeago.format(self.update_time, locale='en_GB'))
+            self.update_time_text.SetLabel("Last updated: "+timeago.format(self.update_time, locale='en_GB'))
         def close(event):
             self.timer.Stop()
+            self.poller.stop()
             self.Destroy()
         self.timer = wx.Timer(self)
         self.timer.Start(1000)
         self.Bind(wx.EVT_TIMER, update_st, self.timer)
         wx.EVT_CLOSE(self, close)
 
+    def on_progress_click(self, event, run):
+        '''
+        Show the progress of each run folder of a run
+        '''
+        progress = run['progress']
+        now = time.time()
+        lines = ['{}: {} of {} image sets'.format(
+            run.job_name, progress['done'], progress['total']
+        ), '']
+        groups = progress['groups']
+        for name in sorted(groups, key=run_number):
+            group = groups[name]
+            lines.append('{}: {} of {} image sets, {}'.format(
+                name, group['done'], group['total'], format_progress(group, now)
+            ))
+        dialog = wx.lib.dialogs.ScrolledMessageDialog(self, '\n'.join(lines), "Progress")
+        dialog.ShowModal()
+        dialog.Destroy()
+
     def on_download_click(self, event, run):
-        self.download(run)
+        folders = None
+        if not run.get('downloaded') and run.get('downloaded_groups'):
+            # Skip the run folders downloaded while the run was going
+            folders = [f for f in run_folders(run) if f not in run['downloaded_groups']]
+        self.busy = True
+        try:
+            self.download(run, folders)
+        finally:
+            self.busy = False
+
+    def on_download_finished_click(self, event, run):
+        folders = self.finished_folders(run)
+        if len(folders) == 0:
+            wx.MessageBox(
+                "No new run folders have finished yet.",
+                caption="Download Finished",
+                style=wx.OK | wx.ICON_INFORMATION)
+            return
+        self.busy = True
+        try:
+            self.download(run, folders)
+        finally:
+            self.busy = False
+
+    def on_resume_upload_click(self, event, run):
+        '''
+        Upload the files that are missing from the cluster and submit the run
+        '''
+        dialog = wx.GenericProgressDialog("Uploading","Uploading files",style=wx.PD_APP_MODAL|wx.PD_CAN_ABORT)
+        self.busy = True
+        try:
+            uploaded = CPRynner.upload_run(run, dialog)
+            if uploaded:
+                dialog.Update( dialog.GetRange()-1, "Submitting" )
+                success = CPRynner.submit_run(run)
+        finally:
+            dialog.Destroy()
+            self.busy = False
+
+        if uploaded and not success:
+            wx.MessageBox(
+                "Failed to submit the run",
+                caption="Submission failed",
+                style=wx.OK | wx.ICON_INFORMATION)
+        self.update()
+        # The button is removed after its event has been handled
+        wx.CallAfter(self.refresh)
+
+    def on_discard_upload_click(self, event, run):
+        CPRynner.discard_upload(run)
+        self.update()
+        wx.CallAfter(self.refresh_pending_uploads)
 
     def on_update_click( self, event ):
         '''
-        Update runs and rebuild the layout
+        Update the pending uploads and start updating the runs
         '''
         self.update()
-        self.draw()
+        self.refresh()
 
     def on_logout_click( self, event ):
+        self.connection = None
         CPRynner.logout()
         self.runs = []
+        self.refresh_run_list()
 
     def on_cluster_settings_click(self, event):
         cluster_address_orig = CPRynner.cluster_url()
@@ -231,69 +527,155 @@ class ClusterviewFrame(wx.Frame):
         cluster_address_new = CPRynner.cluster_url()
 
         if cluster_address_orig != cluster_address_new:
+            self.connection = None
             CPRynner.logout()
+        self.poller.interval = 60*CPRynner.cluster_refresh_interval()
         self.runs = []
         self.update()
-        self.draw()
-
-    def draw(self):
-        self.vbox.Clear(True)
-        self.build_view(self.vbox)
-        self.vbox.Layout()
-        self.FitInside()
+        self.refresh()
 
-    def update( self ):
+    def update( self, full=True ):
         '''
-        Update the run list
+        Update the list of unfinished uploads and start updating the run
+        list in the background. With full, the list of runs is read from
+        the cluster, otherwise only the cached runs that have not completed
+        are updated
         '''
+        self.pending_uploads = CPRynner.pending_uploads()
+        self.full_update = self.full_update or full
+        # Log in here, the background thread cannot ask for a password and
+        # only uses the connection taken here. Without a connection the
+        # cached runs can still be browsed
+        cache = CPRynner.run_cache()
         rynner = CPRynner.CPRynner()
         if rynner is not None:
-            self.runs = [ r for r in rynner.get_runs() if 'upload_time' in r ]
-            rynner.update(self.runs)
-            rynner.update_start_times(self.runs)
-            for run in self.runs:
-                run['status_time'] = rynner.read_time(run)
-            self.update_time = datetime.datetime.now()
+            # Logging in to another account switches to its cache
+            if CPRynner.run_cache().path != cache.path:
+                self.full_update = True
+            self.connection = (rynner, CPRynner.session())
+            self.poller.refresh()
+
+    def fetch_runs( self ):
+        '''
+        Read the runs and their status from the cluster. Called in a
+        background thread by the poller, using only the connection taken
+        in update(), so that it never needs to log in
+        '''
+        connection = self.connection
+        if connection is None or not CPRynner.logged_in():
+            return None
+        rynner, channel = connection
+        full, self.full_update = self.full_update, False
+        if full:
+            # Completed runs do not change on the cluster, but the cache
+            # also knows what has been downloaded
+            cached = dict( (r['id'], r) for r in CPRynner.cached_runs() )
+            runs = [
+                cached[r['id']] if r['id'] in cached else r
+                for r in CPRynner.remote_runs(rynner, channel) if 'upload_time' in r
+            ]
         else:
-            self.runs = []
+            runs = CPRynner.cached_runs()
+        for run in runs:
+            with_defaults(run)
+        # One query for the status of all runs that can still change
+        CPRynner.update_runs([ r for r in runs if not is_finished(r) ], channel)
+        # One read of the progress files of all runs that are running
+        CPRynner.update_progress([ r for r in runs if r.get('slurm_state') == 'RUNNING' ], channel)
+        CPRynner.cache_runs(runs, replace=full)
+        return runs
+
+    def on_runs_fetched( self, runs ):
+        '''
+        Show the runs read in the background
+        '''
+        if self.poller.stopped or self.busy:
+            # The window is closed, or a download will update it when done
+            return
+        self.runs = runs
+        self.update_time = datetime.datetime.now()
+        self.refresh_run_list()
 
+    def on_fetch_failed( self, error ):
+        logger.warning("Failed to update the runs: {}".format(error))
 
 
-    def download( self, run ):
+    def download( self, run, folders=None ):
         '''
         Ask for a destination folder, download files in the results
-        folders and move to the destination
+        folders and move to the destination. Only the given run folders
+        are downloaded if folders is not None
         '''
-        target_directory = self.ask_for_output_dir()
+        if folders is None:
+            folders = [d[0] for d in run.downloads]
+        if len(folders) == 0:
+            # Everything was downloaded while the run was going
+            self.mark_downloaded(run, folders)
+            return True
+
+        target_directory = self.ask_for_output_dir(run.get('download_dir'))
         if not target_directory:
             return False
+
+        patterns = self.ask_download_filter()
+        if patterns is False:
+            return False
             
-        # Download into a temporary directory
-        tmpdir = tempfile.mkdtemp()
-        self.download_to_tempdir(run, tmpdir)
-        
-        # Move the files to the selected folder, handling file names and csv files
-        self.download_file_handling_setup()
-        has_been_downloaded = hasattr(run, 'downloaded') and run.downloaded
-        for runfolder, localdir in run.downloads:
-            self.handle_result_file( 
-                os.path.join(localdir, runfolder, 'results'),
-                target_directory,
-                has_been_downloaded
-            )
+        # Download into a staging folder inside the target directory, so that
+        # moving the files into place is a rename on the same disk
+        tmpdir = tempfile.mkdtemp(prefix='.download_', dir=target_directory)
+        try:
+            folders = self.download_to_tempdir(run, tmpdir, patterns, folders)
+            if len(folders) == 0:
+                wx.MessageBox(
+                    "No result files were found on the cluster for this run.",
+                    caption="Download Results",
+                    style=wx.OK | wx.ICON_INFORMATION)
+                return False
+
+            # Move the files to the selected folder, handling file names and csv files
+            self.download_file_handling_setup(run)
+            has_been_downloaded = hasattr(run, 'downloaded') and run.downloaded
+            for results in results_folders(tmpdir, folders):
+                # All csv files of a run folder get the same image numbers
+                self.csv_merger.start_folder([
+                    os.path.join(target_directory, self.csv_dict.get(name, name))
+                    for root, dirs, names in os.walk(results) for name in names if name.endswith('.csv')
+                ])
+                self.handle_result_file( 
+                    results,
+                    target_directory,
+                    has_been_downloaded
+                )
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        self.mark_downloaded(run, folders, target_directory)
+        return True
 
-        # Set a flag marking the run downloaded
-        run['downloaded'] = True
+    def mark_downloaded(self, run, folders, target_directory=None):
+        '''
+        Remember the downloaded run folders and where they were downloaded
+        to, and mark a completed run downloaded
+        '''
+        run['downloaded_groups'] = sorted(set(run.get('downloaded_groups', [])) | set(folders))
+        if target_directory:
+            run['download_dir'] = target_directory
+        if run.status == 'COMPLETED':
+            run['downloaded'] = True
         CPRynner.CPRynner().save_run_config( run )
+        CPRynner.cache_runs([run])
 
         self.update()
-        self.draw()
+        self.refresh_run_list()
 
-    def ask_for_output_dir(self):
+    def ask_for_output_dir(self, default_target=None):
         '''
-        Ask for a destination for the downloaded files
+        Ask for a destination for the downloaded files, starting from
+        default_target if it exists
         '''
-        default_target = cpprefs.get_default_output_directory()
+        if not default_target or not os.path.isdir(default_target):
+            default_target = cpprefs.get_default_output_directory()
         dialog = wx.DirDialog (None, "Choose an output directory", default_target,
                     wx.DD_DEFAULT_STYLE | wx.DD_DIR_MUST_EXIST)
         try:
@@ -307,23 +689,99 @@ class ClusterviewFrame(wx.Frame):
             dialog.Destroy()
         return target_directory
 
-    def download_to_tempdir(self, run, tmpdir):
+    def ask_download_filter(self):
+        '''
+        Ask which files to download. Returns a list of glob patterns, None
+        for all files or False if cancelled
+        '''
+        dialog = wx.SingleChoiceDialog(None, "Which files should be downloaded?",
+                    "Download Results", [D_ALL, D_MEASUREMENTS, D_PATTERN])
+        try:
+            if dialog.ShowModal() == wx.ID_CANCEL:
+                return False
+            choice = dialog.GetStringSelection()
+        finally:
+            dialog.Destroy()
+
+        if choice == D_MEASUREMENTS:
+            return MEASUREMENT_PATTERNS
+        if choice == D_PATTERN:
+            dialog = wx.TextEntryDialog(None, "File name patterns, separated by spaces (for example *.csv *.png)",
+                        "Download Results", "*.csv")
+            try:
+                if dialog.ShowModal() == wx.ID_CANCEL:
+                    return False
+                patterns = dialog.GetValue().replace(',', ' ').split()
+            finally:
+                dialog.Destroy()
+            return patterns or None
+        return None
+
+    def finished_folders(self, run):
+        '''
+        The run folders the cluster has marked finished that have not been
+        downloaded yet
+        '''
+        markers = list_remote_files(
+            CPRynner.session(),
+            run['remote_dir'],
+            [FINISHED_FOLDER]
+        )
+        finished = set(posixpath.basename(path) for path, size in markers)
+        downloaded = set(run.get('downloaded_groups', []))
+        return [
+            f for f in run_folders(run)
+            if posixpath.basename(f)[len('run'):] in finished and f not in downloaded
+        ]
+
+    def download_to_tempdir(self, run, tmpdir, patterns=None, folders=None):
         '''
         Actually download the files from the cluster into tmpdir,
-        showing a progress dialog
+        showing a progress dialog. Only files matching one of the glob
+        patterns are downloaded if patterns are given. Returns the run
+        folders downloaded, none if no file matched
         '''
-        run.downloads = [ [d[0], tmpdir] for d in run.downloads ]
-        CPRynner.CPRynner().start_download(run)
+        if folders is None:
+            folders = [d[0] for d in run.downloads]
+
+        # List the files in one go, then stream them as compressed archives,
+        # one over each connection of the pool
+        remote_files = list_remote_files(
+            CPRynner.session(),
+            run['remote_dir'],
+            folders,
+            patterns
+        )
+        if len(remote_files) == 0 and folders == [MERGE_FOLDER] and run.get('unmerged_downloads'):
+            # The merge did not run, for example because the job was
+            # cancelled or ran out of time. Fetch the run folders instead
+            folders = [d[0] for d in run['unmerged_downloads']]
+            remote_files = list_remote_files(
+                CPRynner.session(),
+                run['remote_dir'],
+                folders,
+                patterns
+            )
+        if len(remote_files) == 0:
+            return []
+        pool = CPRynner.transfer_pool()
+        pool.start_archive_download(run['remote_dir'], remote_files, tmpdir)
         dialog = wx.GenericProgressDialog("Downloading","Downloading files")
         maximum = dialog.GetRange()
-        while run['download_status'] < 1:
-            value = min( maximum, int(maximum*run['download_status']) )
-            dialog.Update(value)
-            time.sleep(0.04)
-        dialog.Destroy()
+        try:
+            while not pool.finished():
+                value = min( maximum, int(maximum*pool.progress()) )
+                dialog.Update(value)
+                time.sleep(0.04)
+            pool.wait()
+        finally:
+            dialog.Destroy()
+        return folders
 
-    def download_file_handling_setup(self):
+    def download_file_handling_setup(self, run):
         self.csv_dict = {}
+        # Runs saved before this was recorded numbered images per run folder
+        self.csv_merger = CSVMerger(run.get('renumber_images', True))
         self.yes_to_all_clicked = False
 
     def rename_file(self, name):
@@ -358,10 +816,13 @@ class ClusterviewFrame(wx.Frame):
             try:
                 if not os.path.isfile(target_file):
                     # No file name conflict, just move
-                    shutil.move( filename, target_directory )
                     if filename.endswith('.csv'):
-                        # File is .csv, we need to remember this one has been handled already
+                        # File is .csv, we need to remember this one has been handled already.
+                        # Its image numbers may need to follow those of earlier run folders
                         self.csv_dict[name] = name
+                        self.handle_csv( filename, target_file )
+                    else:
+                        shutil.move( filename, target_directory )
                 elif name.endswith('.csv'):
                     # File exists and is csv. Ask the user whether to append or to create a new file
                     if name not in self.csv_dict:
@@ -408,39 +869,8 @@ class ClusterviewFrame(wx.Frame):
     def handle_csv( self, source, destination ):
         ''' Write the data rows of a csv file into an existing csv file.
             Fix image numbering before writing '''
+        self.csv_merger.merge(source, destination)
 
-        # First check if the file contains the image number
-        outfile = open(destination,"rb")
-        header = outfile.next()
-        has_image_num = False
-        for index, cell in enumerate(header.split(',')):
-            if cell == 'ImageNumber':
-                image_num_cell = index
-                has_image_num = True
-
-        # If the image number is included, find the largest value
-        if has_image_num:
-            last_image_num = 1
-            for row in outfile:
-                image_num = int(row.split(',')[image_num_cell])
-                last_image_num = max(image_num, last_image_num)
-        outfile.close()
-
-        # Read the source file and write row by row to the destination
-        infile = open(source, 'rb')
-        infile.next()
-        outfile = open(destination,"ab")
-        for row in infile:
-            # If the image number is included, correct the number
-            if has_image_num:
-                cells = row.split(',')
-                local_num = int(cells[image_num_cell])
-                cells[image_num_cell] = str(image_num+local_num)
-                row = ','.join(cells)
-            outfile.write(row)
-        outfile.close()
-        infile.close()
-                
 
 class clusterView(cpm.Module):
     module_name = "ClusterView"
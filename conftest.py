@@ -0,0 +1,87 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+
+class FakeChannel(object):
+    ''' Answers every command with output and retcode in place of a
+        session, recording the commands. Commands run in a local shell if
+        output is None '''
+    def __init__(self, output=None, retcode=0):
+        self.output = output
+        self.retcode = retcode
+        self.commands = []
+    def execute_wait(self, cmd, walltime=None):
+        self.commands.append(cmd)
+        if self.output is None:
+            output = subprocess.check_output(cmd, shell=True)
+            return 0, output.decode('utf-8'), ''
+        return self.retcode, self.output, ''
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+        self.keepalive = None
+    def is_active(self):
+        return self.active
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+
+class FakeSFTP(object):
+    ''' Copies files locally in place of an SFTP connection '''
+    def putfo(self, infile, destination, size, callback=None):
+        with open(destination, 'wb') as outfile:
+            shutil.copyfileobj(infile, outfile)
+        if callback is not None:
+            callback(size, size)
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+    def close(self):
+        pass
+
+
+class FakeOutput(object):
+    ''' The output of a local process in place of a paramiko channel file '''
+    def __init__(self, process, stream):
+        self.channel = self
+        self.process = process
+        self.stream = stream
+    def read(self, size=-1):
+        return self.stream.read(size)
+    def recv_exit_status(self):
+        return self.process.wait()
+
+
+class FakeSSHClient(object):
+    ''' Runs commands in a local shell in place of an SSH connection. A
+        flaky client drops its connection on the first command '''
+    def __init__(self, flaky=False):
+        self.transport = FakeTransport()
+        self.flaky = flaky
+        self.closed = False
+    def get_transport(self):
+        return self.transport
+    def open_sftp(self):
+        return FakeSFTP()
+    def exec_command(self, cmd, timeout=None):
+        if self.flaky:
+            self.transport.active = False
+            raise EOFError()
+        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return None, FakeOutput(process, process.stdout), FakeOutput(process, process.stderr)
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_channel():
+    return FakeChannel
+
+
+@pytest.fixture
+def fake_ssh_client():
+    return FakeSSHClient
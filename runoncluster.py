@@ -24,7 +24,7 @@ YES          YES          NO
 ============ ============ ===============
 """
 
-import os, time, re
+import os, time, re, posixpath
 from future import *
 import logging
 logger = logging.getLogger(__name__)
@@ -46,6 +46,23 @@ from CPRynner.CPRynner import update_cluster_parameters
 from CPRynner.CPRynner import cluster_tasks_per_node
 from CPRynner.CPRynner import cluster_setup_script
 from CPRynner.CPRynner import cluster_max_runtime
+from CPRynner.CPRynner import cluster_node_memory
+from CPRynner.CPRynner import cluster_cache_dir
+from CPRynner.CPRynner import cluster_partitions
+from CPRynner.CPRynner import local_data_dir
+from CPRynner.CPRynner import upload_run, submit_run, session
+from CPRynner.CPRynner import new_staging_dir, keep_staging_dir
+from CPRynner.transfer import pack_archive, archive_name
+from CPRynner.transfer import UploadManifest, list_remote_dir, cache_uploads
+import CPRynner.planning as planning
+import CPRynner.results as results
+from CPRynner.slurm import choose_partition
+from CPRynner.planning import normalize_file_list, plan_images, plan_archive
+from CPRynner.planning import worker_script, job_script
+
+U_FILES = "Individual files"
+U_ARCHIVE_PER_RUN = "One archive per run folder"
+U_ARCHIVE = "Single archive"
 
 
 class RunOnCluster(cpm.Module):
@@ -55,27 +72,25 @@ class RunOnCluster(cpm.Module):
     # 
     module_name = "RunOnCluster"
     category = 'Other'
-    variable_revision_number = 8
+    variable_revision_number = 18
 
     def is_create_batch_module(self):
         return True
 
     def upload( self, run, dialog = None ):
-        rynner = CPRynner()
-
+        ''' Upload the run files. Returns False if the upload was cancelled '''
         if dialog == None:
-            dialog = wx.GenericProgressDialog("Uploading","Uploading files")
+            dialog = wx.GenericProgressDialog("Uploading","Uploading files",style=wx.PD_CAN_ABORT)
             destroy_dialog = True
         else:
             destroy_dialog = False
 
-        if rynner is not None:
-            rynner.start_upload(run)
-            maximum = dialog.GetRange()
-            while run['upload_status'] < 1:
-                value = min( maximum, int(maximum*run['upload_status']) )
-                dialog.Update(value)
-            dialog.Update(maximum-1)
+        try:
+            if not upload_run(run, dialog):
+                return False
+            dialog.Update(dialog.GetRange()-1)
+            return True
+        finally:
             if destroy_dialog:
                 dialog.Destroy()
 
@@ -100,6 +115,11 @@ class RunOnCluster(cpm.Module):
             value=True,
             doc= "Wether the images are ordered by image type first. If not, ordering by measurement first is assumed."
         )
+        self.balance_by_size = cellprofiler.setting.Binary(
+            text="Balance run folders by file size",
+            value=False,
+            doc="Divide the measurements between the run folders so that each folder holds roughly the same amount of image data, instead of the same number of measurements. Useful when the image sizes vary a lot, for example when mixing 2D images and 3D stacks."
+        )
         self.is_archive = cellprofiler.setting.Binary(
             text="Is image archive",
             value=False,
@@ -116,12 +136,78 @@ class RunOnCluster(cpm.Module):
             24,
             doc = "The maximum time for reserving a node on the cluster. Should be higher than the actual runtime, or the run may not compelte. Runs with lower values will pass the queue more quickly."
         )
+        self.task_memory = cellprofiler.setting.Float(
+            "Memory per task (GB)",
+            0,
+            minval=0,
+            doc = "The memory needed by a single CellProfiler process running this pipeline. The number of processes run at the same time on a node is limited so that they fit into the node memory set in the cluster settings, and the memory is requested from Slurm. Set to 0 to run one process per task and leave the memory request to the cluster defaults."
+        )
+        self.stage_on_node = cellprofiler.setting.Binary(
+            text="Stage files on node-local scratch",
+            value=False,
+            doc="Copy the images to the local scratch disk of the compute node (the folder in TMPDIR, or /tmp) before processing, write the results there and copy them back to the run folder in one go when done. Reduces the load on the shared cluster file system when many processes read and write small files. Needs enough local disk space for the images of a run folder, or of all shared images when using the dynamic work queue."
+        )
+        self.merge_on_cluster = cellprofiler.setting.Binary(
+            text="Merge results on the cluster",
+            value=False,
+            doc="Merge the csv files of all run folders on the cluster once the run has finished, so that only a single set of result files needs to be downloaded. The image numbers are fixed in the same way as when merging after download."
+        )
+        self.partition = cps.Text(
+            "Partition",
+            "",
+            doc = "The Slurm partition to submit the run to. Leave empty to choose the partition automatically: the partitions of the cluster are looked up once per session, and the run goes to the one that can start soonest and process the images in the shortest time. The number of tasks per node and the node memory are taken from the chosen partition instead of the cluster settings.",
+        )
+        self.n_nodes = cellprofiler.setting.Integer(
+            "Number of nodes",
+            1,
+            minval=1,
+            doc = "The number of cluster nodes to spread the run over. The images are divided into run folders for each core on each node. Large runs finish sooner on more nodes, but requesting more nodes may increase the time spent in the queue."
+        )
+        self.job_array = cellprofiler.setting.Binary(
+            text="Submit as job array",
+            value=False,
+            doc="Submit each run folder as a separate element of a Slurm job array instead of reserving whole nodes. Small array tasks usually start sooner and release their resources as soon as they finish."
+        )
+        self.array_throttle = cellprofiler.setting.Integer(
+            "Maximum simultaneous array tasks",
+            0,
+            minval=0,
+            doc = "The maximum number of array tasks allowed to run at the same time. Set to 0 for no limit."
+        )
+        self.dynamic_queue = cellprofiler.setting.Binary(
+            text="Distribute work dynamically",
+            value=False,
+            doc="Instead of dividing the images evenly between the cores in advance, split them into small chunks that the workers take from a shared queue until it is empty. Workers that finish early take on more chunks, so uneven processing times do not hold up the whole run."
+        )
+        self.chunk_size = cellprofiler.setting.Integer(
+            "Measurements per chunk",
+            10,
+            minval=1,
+            doc = "The number of measurements processed by a worker at a time when work is distributed dynamically. Smaller chunks balance the work better, but each chunk pays the CellProfiler startup time."
+        )
         self.account = cps.Text( 
             "Project Code",
             "",
             doc = "Enter a project code of an Supercomputing Wales project you wish to run under. This can be left empty if you have only one project.",
         )
 
+        self.upload_method = cps.Choice(
+            "Upload method",
+            [U_FILES, U_ARCHIVE_PER_RUN, U_ARCHIVE],
+            U_FILES,
+            doc = "How the images are transferred to the cluster. Sending each file separately costs a round trip per file, which dominates for large numbers of small images. The archive options pack the images into tar archives that are unpacked on the cluster, either one for each run folder or one for the whole batch. The archives are written next to the run scripts and require free local disk space."
+        )
+        self.compress_upload = cps.Binary(
+            "Compress upload archive",
+            False,
+            doc = "Compress the upload archives with gzip. Only useful if the images compress well and the network is slow."
+        )
+        self.use_upload_cache = cps.Binary(
+            "Use upload cache",
+            False,
+            doc = "Keep a copy of uploaded images in a cache folder in the cluster working directory and only upload images that are not already in the cache. Images are recognised by their contents, so resubmitting the same images with a modified pipeline does not upload them again. The cache is not cleaned automatically."
+        )
+
         self.cluster_settings_button = cps.DoSomething("",
             "Cluster Settings",
             update_cluster_parameters,
@@ -141,6 +227,19 @@ class RunOnCluster(cpm.Module):
             self.measurements_in_archive,
             self.max_walltime,
             self.account,
+            self.upload_method,
+            self.compress_upload,
+            self.use_upload_cache,
+            self.n_nodes,
+            self.job_array,
+            self.array_throttle,
+            self.dynamic_queue,
+            self.chunk_size,
+            self.balance_by_size,
+            self.task_memory,
+            self.stage_on_node,
+            self.merge_on_cluster,
+            self.partition,
             self.batch_mode,
             self.revision,
         ]
@@ -161,10 +260,31 @@ class RunOnCluster(cpm.Module):
             result += [
                 self.n_images_per_measurement,
                 self.type_first,
+                self.upload_method,
             ]
+            if self.upload_method.value != U_FILES:
+                result += [self.compress_upload]
+
+        result += [self.use_upload_cache]
 
         result += [
             self.max_walltime,
+            self.task_memory,
+            self.stage_on_node,
+            self.merge_on_cluster,
+            self.partition,
+            self.job_array,
+        ]
+        if self.job_array.value:
+            result += [self.array_throttle]
+        else:
+            result += [self.n_nodes, self.dynamic_queue]
+            if self.dynamic_queue.value:
+                result += [self.chunk_size]
+        if not self.is_archive.value and not (self.dynamic_queue.value and not self.job_array.value):
+            result += [self.balance_by_size]
+
+        result += [
             self.account,
             self.cluster_settings_button,
         ]
@@ -179,17 +299,107 @@ class RunOnCluster(cpm.Module):
             self.measurements_in_archive,
             self.max_walltime,
             self.account,
+            self.upload_method,
+            self.compress_upload,
+            self.use_upload_cache,
+            self.n_nodes,
+            self.job_array,
+            self.array_throttle,
+            self.dynamic_queue,
+            self.chunk_size,
+            self.balance_by_size,
+            self.task_memory,
+            self.stage_on_node,
+            self.merge_on_cluster,
+            self.partition,
         ]
 
         return help_settings
 
     def group_images( self, list, n_measurements, measurements_per_run, groups_first = True ):
         ''' Divides a list of images into numbered groups and returns a list enumerated by the group numbers '''
-        if groups_first:
-            images_per_run = len(list)/n_measurements * measurements_per_run
-            return [(int(i/images_per_run), name) for i, name in enumerate(list)]
-        else :
-            return [(int((i%n_measurements)/measurements_per_run), name) for i, name in enumerate(list)]
+        groups = planning.group_images(len(list), n_measurements, measurements_per_run, groups_first)
+        return [(g, name) for g, name in zip(groups.tolist(), list)]
+
+    def pack_uploads( self, uploads, local_dir, per_run = True ):
+        ''' Pack image uploads into tar archives according to the upload method.
+            Returns the new upload list, the command for unpacking the archive in
+            the job script and the command for unpacking in each run folder '''
+        compress = self.compress_upload.value
+        name = archive_name(compress)
+        unpack = "tar -xf {0} && rm {0}; ".format(name)
+
+        # Packing many images takes a while, so a progress dialog is shown
+        dialog = wx.GenericProgressDialog(
+            "Packing images", "Packing the images into archives",
+            maximum=max(1, len(uploads)), style=wx.PD_APP_MODAL|wx.PD_AUTO_HIDE
+        )
+        # Updating the dialog for every image would slow down packing
+        step = max(1, len(uploads) // 100)
+        def progress(packed):
+            ''' A callback for pack_archive, after packed images in earlier archives '''
+            def callback(n):
+                if (packed + n) % step == 0:
+                    dialog.Update(packed + n)
+            return callback
+
+        try:
+            if self.upload_method.value == U_ARCHIVE or not per_run:
+                # A single archive for the batch, unpacked once by the job script
+                archive_path = os.path.join(local_dir, name)
+                members = [(path, posixpath.join(dest, os.path.basename(path))) for path, dest in uploads]
+                pack_archive(archive_path, members, compress, progress(0))
+                return [[archive_path, '.']], unpack, ''
+
+            # One archive per run folder, unpacked by the run script
+            run_members = {}
+            for path, dest in uploads:
+                run_folder, subfolder = dest.split('/', 1)
+                run_members.setdefault(run_folder, []).append(
+                    (path, posixpath.join(subfolder, os.path.basename(path)))
+                )
+            new_uploads = []
+            packed = 0
+            for run_folder, members in sorted(run_members.items()):
+                archive_dir = os.path.join(local_dir, run_folder)
+                if not os.path.isdir(archive_dir):
+                    os.makedirs(archive_dir)
+                archive_path = os.path.join(archive_dir, name)
+                pack_archive(archive_path, members, compress, progress(packed))
+                packed += len(members)
+                new_uploads += [[archive_path, run_folder]]
+            return new_uploads, '', unpack
+        finally:
+            dialog.Destroy()
+
+    def skip_cached_uploads( self, uploads, local_dir ):
+        ''' Remove images already in the cluster upload cache from the uploads.
+            Returns the remaining uploads and the path of a script linking the
+            images between the cache and the run folders. Hashing the images
+            can take a while, so a progress dialog is shown '''
+        cache_dir = cluster_cache_dir()
+        cached = list_remote_dir(session(), cache_dir)
+
+        manifest = UploadManifest(os.path.join(local_data_dir(), 'upload_manifest.json'))
+        dialog = wx.GenericProgressDialog(
+            "Upload cache", "Checking the images against the upload cache",
+            maximum=max(1, len(uploads)), style=wx.PD_APP_MODAL|wx.PD_AUTO_HIDE
+        )
+        # Updating the dialog for every image would slow down hashing
+        step = max(1, len(uploads) // 100)
+        def callback(n):
+            if n % step == 0:
+                dialog.Update(n)
+        try:
+            uploads, script = cache_uploads(uploads, manifest, cache_dir, cached, callback)
+        finally:
+            dialog.Destroy()
+        manifest.save()
+
+        script_path = os.path.join(local_dir, 'link_cache')
+        with open(script_path, "w") as file:
+            file.write(script)
+        return uploads, script_path
 
     def prepare_run(self, workspace):
         '''Invoke the image_set_list pickling mechanism and save the pipeline'''
@@ -204,20 +414,21 @@ class RunOnCluster(cpm.Module):
             rynner = CPRynner()
             if rynner is not None:
                 # Get parameters
-                max_tasks = int(cluster_tasks_per_node())
+                tasks_per_node = int(cluster_tasks_per_node())
+                node_memory = cluster_node_memory()
+                if self.job_array.value:
+                    n_nodes = 1
+                    dynamic = False
+                else:
+                    n_nodes = self.n_nodes.value
+                    dynamic = self.dynamic_queue.value
                 setup_script = cluster_setup_script()
 
                 # Set walltime
                 rynner.provider.walltime = str(self.max_walltime.value)+":00:00"
 
-                # save the pipeline
-                path = self.save_pipeline(workspace)
-
                 # Create the run data structure
-                file_list = pipeline.file_list
-                file_list = [name.replace('file:///','') for name in file_list]
-                file_list = [name.replace('file:','') for name in file_list]
-                file_list = [name.replace('%20',' ') for name in file_list]
+                file_list = normalize_file_list(pipeline.file_list)
 
                 if len(file_list) == 0:
                     wx.MessageBox(
@@ -226,18 +437,68 @@ class RunOnCluster(cpm.Module):
                     style=wx.OK | wx.ICON_INFORMATION)
                     return False
 
+                # Size the run for the partition, if the cluster lists them
+                partition_name = self.partition.value.strip()
+                partitions = cluster_partitions()
+                if len(partitions) > 0:
+                    if self.is_archive.value:
+                        n_measurements = self.measurements_in_archive.value
+                    else:
+                        n_measurements = len(file_list) // self.n_images_per_measurement.value
+                    partition = choose_partition(
+                        partitions, n_measurements, self.max_walltime.value,
+                        n_nodes, self.task_memory.value, partition_name
+                    )
+                    if partition is None:
+                        wx.MessageBox(
+                        "No partition on the cluster has enough nodes and a long enough time limit for this run.",
+                        caption="RunOnCluster: No partition",
+                        style=wx.OK | wx.ICON_INFORMATION)
+                        return False
+                    partition_name = partition['name']
+                    tasks_per_node = partition['cpus']
+                    node_memory = partition['memory']
+                max_tasks = tasks_per_node*n_nodes
+
+                # The pipeline, scripts and archives of the run are written
+                # to a folder of their own, kept until the run is submitted
+                staging = new_staging_dir()
+
+                # save the pipeline
+                path = self.save_pipeline(workspace, os.path.join(staging, F_BATCH_DATA_H5))
+
                 # Divide measurements to runs according to the number of cores on a node
                 n_images = len(file_list)
+                job_unpack = ''
+                run_unpack = ''
+                link_script = None
+                chunk_size = self.chunk_size.value if dynamic else None
                 
                 if not self.is_archive.value:
-                    n_measurements = int(n_images/self.n_images_per_measurement.value)
-                    measurements_per_run = int(n_measurements/max_tasks) + 1
-
-                    grouped_images = self.group_images( file_list, n_measurements, measurements_per_run, self.type_first.value)
-                    n_image_groups = max(zip(*grouped_images)[0]) + 1
+                    costs = None
+                    if self.balance_by_size.value and not dynamic:
+                        costs = [os.path.getsize(name) for name in file_list]
+                    plan = plan_images(
+                        n_images, self.n_images_per_measurement.value, max_tasks,
+                        self.type_first.value, costs, chunk_size
+                    )
 
                     # Add image files to uploads
-                    uploads = [[name, 'run{}/images'.format(g)] for g,name in grouped_images]
+                    uploads = plan.image_uploads(file_list)
+
+                    # Only upload images missing from the cluster cache
+                    if self.use_upload_cache.value:
+                        uploads, link_script = self.skip_cached_uploads(uploads, staging)
+
+                    # Pack the images into archives if requested
+                    if self.upload_method.value != U_FILES and len(uploads) > 0:
+                        uploads, job_unpack, run_unpack = self.pack_uploads(uploads, staging, not plan.shared)
+                        if self.use_upload_cache.value and run_unpack:
+                            # New images must be in place before the cache is updated
+                            job_unpack = "for a in run*/{0}; do tar -xf $a -C $(dirname $a) && rm $a; done; ".format(
+                                archive_name(self.compress_upload.value)
+                            )
+                            run_unpack = ''
 
                 else:
                     if n_images > 1:
@@ -248,52 +509,70 @@ class RunOnCluster(cpm.Module):
                         return False
                     
                     uploads = [[file_list[0], 'images']]
+                    if self.use_upload_cache.value:
+                        uploads, link_script = self.skip_cached_uploads(uploads, staging)
 
-                    n_measurements = self.measurements_in_archive.value
-                    n_image_groups = max_tasks
-
+                    plan = plan_archive(self.measurements_in_archive.value, max_tasks, chunk_size)
 
                 # Also add the pipeline
                 uploads +=  [[path,'.']]
 
-                # The runs are downloaded in their separate folders. They can be processed later
-                output_dir = cpprefs.get_default_output_directory()
-                downloads = [['run{}'.format(g),output_dir] for g in range(n_image_groups)]
-
-                # Create run scripts and add to uploads
-                for g in range(n_image_groups):
-                    runscript_name = 'cellprofiler_run{}'.format(g)
-                    local_script_path = os.path.join(rynner.provider.script_dir, runscript_name)
-
-                    if not self.is_archive.value:
-                        n_measurements = len([ i for i in   grouped_images if i[0]==g ]) /    self.n_images_per_measurement.value
-                        script = "cellprofiler -c -p ../Batch_data.h5 -o results -i images -f 1 -l {} 2>>../cellprofiler_output; rm -r images".format(n_measurements)
-                    
-                    else:
-                        n_images_per_group = int(n_measurements/max_tasks)
-                        n_additional_images = int(n_measurements%max_tasks)
-
-                        if g < n_additional_images:
-                            first = (n_images_per_group+1)*g
-                            last = (n_images_per_group+1)*(g+1)
-                        else:
-                            first = n_images_per_group*g + n_additional_images
-                            last = n_images_per_group*(g+1) + n_additional_images
-
-                        script = "mkdir images; cp ../images/* images; cellprofiler -c -p ../Batch_data.h5 -o results -i images -f {} -l {} 2>>../cellprofiler_output; rm -r images".format(first, last)
-
-                    with open(local_script_path, "w") as file:
-                        file.write(script)
+                # The cache link script runs once the images are unpacked
+                if link_script is not None:
+                    uploads += [[link_script, '.']]
+                    job_unpack += 'bash link_cache; '
 
-                    uploads += [[local_script_path,"run{}".format(g)]]
+                # The runs are downloaded in their separate folders. They can be processed later.
+                # The chunks of a dynamic run are downloaded together from their folder
+                output_dir = cpprefs.get_default_output_directory()
+                if plan.chunked:
+                    downloads = [[planning.CHUNK_FOLDER, output_dir]]
+                else:
+                    downloads = [[plan.folder(g), output_dir] for g in range(plan.n_runs)]
+
+                # Merge the results on the cluster and only download the merged folder.
+                # The run folders are downloaded instead if the merge did not run
+                unmerged_downloads = []
+                if self.merge_on_cluster.value:
+                    uploads += [[os.path.splitext(results.__file__)[0] + '.py', '.']]
+                    unmerged_downloads = downloads
+                    downloads = [[planning.MERGE_FOLDER, output_dir]]
+
+                if plan.chunked:
+                    # Workers claim chunks from a shared queue. A single script
+                    # processes any chunk from the list of chunk ranges
+                    for name, content in [
+                        ('cellprofiler_worker', worker_script()),
+                        (planning.CHUNK_SCRIPT, plan.chunk_script(self.stage_on_node.value)),
+                        (planning.CHUNK_RANGES, plan.chunk_list()),
+                    ]:
+                        local_path = os.path.join(staging, name)
+                        with open(local_path, "w") as file:
+                            file.write(content)
+                        uploads += [[local_path, '.']]
+                else:
+                    # Create run scripts and add to uploads
+                    for g in range(plan.n_runs):
+                        runscript_name = 'cellprofiler_run{}'.format(g)
+                        local_script_path = os.path.join(staging, runscript_name)
+                        with open(local_script_path, "w") as file:
+                            file.write(plan.run_script(g, run_unpack, self.stage_on_node.value))
 
+                        uploads += [[local_script_path, plan.folder(g)]]
 
                 # Define the job to run
-                script = '{}; printf %s\\\\n {{0..{}}} | xargs -P 40 -n 1 -IX bash -c "cd runX ; ./cellprofiler_runX; ";'.format(
-                    setup_script, n_image_groups-1
+                script, overrides = job_script(
+                    plan, setup_script, job_unpack,
+                    n_nodes = n_nodes,
+                    tasks_per_node = tasks_per_node,
+                    array = self.job_array.value,
+                    array_throttle = self.array_throttle.value,
+                    dynamic = dynamic,
+                    node_memory = node_memory,
+                    task_memory = self.task_memory.value,
+                    stage = self.stage_on_node.value,
+                    merge = self.merge_on_cluster.value,
                 )
-                script = script.replace('\r\n','\n')
-                script = script.replace(';;', ';')
                 print(script)
                 run = rynner.create_run( 
                     jobname = self.runname.value.replace(' ','_'),
@@ -301,17 +580,33 @@ class RunOnCluster(cpm.Module):
                     uploads = uploads,
                     downloads =  downloads,
                 )
+                keep_staging_dir(run, staging)
 
                 run['account'] = self.account.value
+                run['walltime'] = rynner.provider.walltime
+                run['nodes'] = n_nodes
+                run['partition'] = partition_name
+                run['image_sets'] = sum(plan.n_sets(g) for g in range(plan.n_runs))
+                run['chunks'] = plan.n_runs if plan.chunked else 0
+                run['unmerged_downloads'] = unmerged_downloads
+                # Run folders reading a shared image list number images in the whole list
+                run['renumber_images'] = not plan.shared
+                run['overrides'] = overrides
 
                 # Copy the pipeline and images accross
-                dialog = wx.GenericProgressDialog("Uploading","Uploading files",style=wx.PD_APP_MODAL)
+                dialog = wx.GenericProgressDialog("Uploading","Uploading files",style=wx.PD_APP_MODAL|wx.PD_CAN_ABORT)
                 try:
-                    self.upload(run, dialog)
+                    if not self.upload(run, dialog):
+                        dialog.Destroy()
+                        wx.MessageBox(
+                    "The upload was cancelled. It can be resumed from ClusterView.",
+                        caption="RunOnCluster: Upload cancelled",
+                        style=wx.OK | wx.ICON_INFORMATION)
+                        return False
 
                     # Submit the run
                     dialog.Update( dialog.GetRange()-1, "Submitting" )
-                    success = CPRynner().submit(run)
+                    success = submit_run(run)
                     dialog.Destroy()
                     
                     if success:
@@ -326,6 +621,10 @@ class RunOnCluster(cpm.Module):
                         style=wx.OK | wx.ICON_INFORMATION)
                 except Exception as e:
                     dialog.Destroy()
+                    wx.MessageBox(
+                "The upload failed. It can be resumed from ClusterView once the connection works again.",
+                    caption="RunOnCluster: Failure",
+                    style=wx.OK | wx.ICON_INFORMATION)
                     raise e
 
 
@@ -417,7 +716,54 @@ class RunOnCluster(cpm.Module):
             raise NotImplementedError("Attempting to import RunOnCluster from Matlab.")
             
         if (not from_matlab) and variable_revision_number == 8:
-            pass
+            # Version 9 added the upload method and archive compression
+            setting_values = setting_values[:7] + [U_FILES, "No"] + setting_values[7:]
+            variable_revision_number = 9
+
+        if (not from_matlab) and variable_revision_number == 9:
+            # Version 10 added the upload cache
+            setting_values = setting_values[:9] + ["No"] + setting_values[9:]
+            variable_revision_number = 10
+
+        if (not from_matlab) and variable_revision_number == 10:
+            # Version 11 added the number of nodes
+            setting_values = setting_values[:10] + ["1"] + setting_values[10:]
+            variable_revision_number = 11
+
+        if (not from_matlab) and variable_revision_number == 11:
+            # Version 12 added job arrays
+            setting_values = setting_values[:11] + ["No", "0"] + setting_values[11:]
+            variable_revision_number = 12
+
+        if (not from_matlab) and variable_revision_number == 12:
+            # Version 13 added the dynamic work queue
+            setting_values = setting_values[:13] + ["No", "10"] + setting_values[13:]
+            variable_revision_number = 13
+
+        if (not from_matlab) and variable_revision_number == 13:
+            # Version 14 added balancing by file size
+            setting_values = setting_values[:15] + ["No"] + setting_values[15:]
+            variable_revision_number = 14
+
+        if (not from_matlab) and variable_revision_number == 14:
+            # Version 15 added the memory per task
+            setting_values = setting_values[:16] + ["0"] + setting_values[16:]
+            variable_revision_number = 15
+
+        if (not from_matlab) and variable_revision_number == 15:
+            # Version 16 added staging on node-local scratch
+            setting_values = setting_values[:17] + ["No"] + setting_values[17:]
+            variable_revision_number = 16
+
+        if (not from_matlab) and variable_revision_number == 16:
+            # Version 17 added merging results on the cluster
+            setting_values = setting_values[:18] + ["No"] + setting_values[18:]
+            variable_revision_number = 17
+
+        if (not from_matlab) and variable_revision_number == 17:
+            # Version 18 added the partition
+            setting_values = setting_values[:19] + [""] + setting_values[19:]
+            variable_revision_number = 18
 
         if variable_revision_number < 8:
              # There are no older implementations
@@ -0,0 +1,97 @@
+"""
+Stand-ins for packages that are not installed, so that the plugin modules
+can be imported in tests without wx or CellProfiler. Works with Python 2
+and 3.
+"""
+
+import contextlib
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stub(types.ModuleType):
+    ''' A missing module. Any attribute is a new class, so that the plugins
+        can subclass wx and CellProfiler classes '''
+    __path__ = []
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = type(name, (object,), {})
+        setattr(self, name, value)
+        return value
+
+
+class StubFinder(object):
+    ''' Imports a Stub for the given packages and their modules '''
+
+    def __init__(self, packages):
+        self.packages = packages
+
+    def stubbed(self, name):
+        return name.split('.')[0] in self.packages
+
+    # Python 2
+    def find_module(self, name, path=None):
+        return self if self.stubbed(name) else None
+
+    def load_module(self, name):
+        if name not in sys.modules:
+            sys.modules[name] = Stub(name)
+        return sys.modules[name]
+
+    # Python 3
+    def find_spec(self, name, path=None, target=None):
+        if not self.stubbed(name):
+            return None
+        import importlib.machinery
+        return importlib.machinery.ModuleSpec(name, self, is_package=True)
+
+    def create_module(self, spec):
+        return Stub(spec.name)
+
+    def exec_module(self, module):
+        pass
+
+
+def is_installed(package):
+    try:
+        import importlib.util
+        return importlib.util.find_spec(package) is not None
+    except ImportError:
+        import imp
+        try:
+            imp.find_module(package)
+            return True
+        except ImportError:
+            return False
+
+
+def install(packages):
+    ''' Stub those of the given top level packages that are not installed '''
+    missing = [p for p in packages if not is_installed(p)]
+    sys.meta_path.insert(0, StubFinder(missing))
+    return missing
+
+
+@contextlib.contextmanager
+def stubbed(packages):
+    ''' Stub those of the given top level packages that are not installed
+        while importing. Afterwards the stubs and the plugin modules
+        imported with them are forgotten, so that later imports see the
+        real packages or fail as usual '''
+    before = set(sys.modules)
+    finder = StubFinder([p for p in packages if not is_installed(p)])
+    sys.meta_path.insert(0, finder)
+    try:
+        yield finder.packages
+    finally:
+        sys.meta_path.remove(finder)
+        for name in set(sys.modules) - before:
+            module = sys.modules[name]
+            path = os.path.abspath(getattr(module, '__file__', None) or '')
+            if isinstance(module, Stub) or path.startswith(ROOT + os.sep):
+                del sys.modules[name]
@@ -0,0 +1,29 @@
+import types
+
+import stubs
+from CPRynner.runcache import RunCache
+
+# Packages the plugin needs that may not be installed where the tests run
+GUI_PACKAGES = ['wx', 'cellprofiler', 'future', 'timeago', 'box']
+
+
+class Run(dict):
+    ''' Stands in for box.Box '''
+    def __getattr__(self, name):
+        return self[name]
+
+
+def test_show_submitted_run(tmpdir):
+    with stubs.stubbed(GUI_PACKAGES):
+        import clusterview
+
+    # Runs are cached when submitted, before their status is read
+    cache = RunCache(str(tmpdir.join('runs.sqlite')))
+    cache.save([{'id': 'a', 'job_name': 'new', 'upload_time': 1000.0, 'qid': '123', 'downloads': [['run0', '/out']]}])
+    run = Run(cache.runs()[0])
+    row = clusterview.run_row(run)
+    assert row[0:2] == ['new', 'PENDING']
+    assert row[3:] == ['', '', '']
+
+    view = types.SimpleNamespace(runs=[run], status_filter_index=1, age_filter_index=0)
+    assert clusterview.ClusterviewFrame.filter_runs(view) == [run]
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Only imported once the cluster is used
+HEAVY_MODULES = ['paramiko', 'rynner', 'libsubmit', 'box']
+
+# Stubbed when not installed, so that the plugins can be imported without
+# wx and CellProfiler. A stubbed heavy module still shows up when imported
+PLUGIN_PACKAGES = ['wx', 'cellprofiler', 'future', 'timeago'] + HEAVY_MODULES
+
+# Import time allowed for the modules loaded with the plugins, in seconds
+MAX_IMPORT_TIME = 1.0
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_SCRIPT = """
+import os, sys, time
+import stubs
+stubs.install({!r})
+cwd = os.getcwd()
+start = time.time()
+import {}
+print(time.time() - start)
+print(os.getcwd() == cwd)
+print(' '.join(m for m in {!r} if m in sys.modules))
+"""
+
+
+def import_in_subprocess(module):
+    ''' Import time, whether the working directory was kept and the heavy
+        modules loaded when importing a module in a fresh interpreter '''
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_SCRIPT.format(PLUGIN_PACKAGES, module, HEAVY_MODULES)], cwd=ROOT
+    ).decode('utf-8').split('\n')
+    return float(output[0]), output[1] == 'True', output[2].split()
+
+@pytest.mark.parametrize('module', [
+    'CPRynner.planning', 'CPRynner.transfer', 'CPRynner.session', 'CPRynner.slurm',
+    'CPRynner.results', 'CPRynner.runcache', 'CPRynner.polling', 'CPRynner.progress',
+    'CPRynner.CPRynner', 'runoncluster', 'clusterview',
+])
+def test_import_time(module):
+    seconds, kept_cwd, heavy = import_in_subprocess(module)
+    assert seconds < MAX_IMPORT_TIME
+    assert kept_cwd
+    assert heavy == []
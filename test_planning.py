@@ -0,0 +1,208 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import numpy as np
+
+from CPRynner import planning
+from CPRynner.planning import normalize_file_list, plan_images, plan_archive
+from CPRynner.planning import chunk_ranges, job_script, worker_script, worker_concurrency, tracked_command
+
+
+def test_normalize_file_list():
+    file_list = ['file:///home/user/a%20b.tif', 'file:C:/images/c.tif', '/data/d.tif']
+    assert normalize_file_list(file_list) == ['home/user/a b.tif', 'C:/images/c.tif', '/data/d.tif']
+    assert normalize_file_list([]) == []
+
+def test_group_images():
+    groups = planning.group_images(8, 4, 2, groups_first = False)
+    assert groups.tolist() == [0,0,1,1,0,0,1,1]
+
+    groups = planning.group_images(8, 4, 2, groups_first = True)
+    assert groups.tolist() == [0,0,0,0,1,1,1,1]
+
+def test_balance_groups():
+    groups = planning.balance_groups(8, 8, 2, [10,1,1,1,1,1,1,1])
+    assert groups.tolist() == [0,1,1,1,1,1,1,1]
+
+    # Two images per measurement, measurement first
+    costs = [5,5,1,1,1,1,1,1]
+    groups = planning.balance_groups(8, 4, 2, costs, groups_first = True)
+    assert groups.tolist() == [0,0,1,1,1,1,1,1]
+
+    # Two images per measurement, image type first
+    groups = planning.balance_groups(8, 4, 2, costs, groups_first = False)
+    assert groups.tolist() == [0,1,0,1,0,1,0,1]
+
+def test_chunk_ranges():
+    assert chunk_ranges(10, 4) == [(1,4),(5,8),(9,10)]
+    assert chunk_ranges(8, 4) == [(1,4),(5,8)]
+
+def test_plan_images():
+    plan = plan_images(16, 2, 3)
+    assert plan.n_runs == 3
+    assert plan.ranges == [(1,3),(1,3),(1,2)]
+    uploads = plan.image_uploads(['image{}'.format(i) for i in range(16)])
+    assert uploads[0] == ('image0', 'run0/images')
+    assert uploads[15] == ('image15', 'run2/images')
+    assert plan.run_script(2) == "{}; rm -r images; {}".format(
+        tracked_command("cellprofiler -c -p ../Batch_data.h5 -o results -i images -f 1 -l 2", 2, "../cellprofiler_output"),
+        'if [ "$status" = 0 ]; then marker=finished; else marker=failed; fi; mkdir -p ../$marker; touch ../$marker/2'
+    )
+    assert plan.n_sets(2) == 2
+
+    plan = plan_images(16, 2, 3, chunk_size = 3)
+    assert plan.shared
+    assert plan.ranges == [(1,3),(4,6),(7,8)]
+    assert plan.image_uploads(['image0']) == [('image0', 'images')]
+    assert plan.chunked
+    assert plan.folder(1) == 'chunks/run1'
+    assert "-i ../../images -f 4 -l 6" in plan.run_script(1)
+    assert plan.run_script(1).endswith("mkdir -p ../../$marker; touch ../../$marker/1")
+    assert "-i ../../images -f $FIRST -l $LAST" in plan.chunk_script()
+    assert plan.chunk_list() == "0 1 3\n1 4 6\n2 7 8\n"
+
+def test_plan_archive():
+    plan = plan_archive(10, 4)
+    assert plan.n_runs == 4
+    # CellProfiler counts image sets from 1, and each is processed once
+    assert plan.ranges == [(1,3),(4,6),(7,8),(9,10)]
+    assert sum(plan.n_sets(g) for g in range(plan.n_runs)) == 10
+    assert "-f 1 -l 3" in plan.run_script(0)
+    assert plan.run_script(0).startswith("ln -sfn ../images images;")
+    assert "cp " not in plan.run_script(0)
+    assert plan.archive
+
+def test_job_script():
+    plan = plan_images(8, 1, 3)
+    script, overrides = job_script(plan, 'module load cellprofiler;', tasks_per_node = 40)
+    assert script == 'module load cellprofiler; printf %s\\\\n {0..2} | xargs -P 40 -n 1 -IX bash -c "cd runX ; ./cellprofiler_runX; ";'
+    assert overrides == '#SBATCH --ntasks-per-node=1\n#SBATCH --cpus-per-task=40'
+
+    script, overrides = job_script(plan, 'setup', n_nodes = 2, tasks_per_node = 4)
+    assert "srun --nodes=2 --ntasks=2 --ntasks-per-node=1 --cpus-per-task=4 bash -c 'seq $SLURM_PROCID 2 2" in script
+
+    script, overrides = job_script(plan, 'setup', 'tar -xf images.tar; ', array = True, array_throttle = 2)
+    assert 'cd run$SLURM_ARRAY_TASK_ID' in script
+    assert 'if mkdir .prepare' in script
+    assert overrides == '#SBATCH --ntasks=1\n#SBATCH --cpus-per-task=1\n#SBATCH --array=0-2%2'
+
+    plan = plan_images(8, 1, 4, chunk_size = 2)
+    script, overrides = job_script(plan, 'setup', tasks_per_node = 40, dynamic = True)
+    assert 'mkdir -p queue; seq 1 40 | xargs -P 40 -n 1 -IX ./cellprofiler_worker' in script
+    assert script.endswith('rm -r images;')
+
+def test_worker_concurrency():
+    assert worker_concurrency(40) == 40
+    assert worker_concurrency(40, 128, 0) == 40
+    assert worker_concurrency(40, 128, 4) == 32
+    assert worker_concurrency(64, 256, 3) == 64
+    assert worker_concurrency(40, 8, 16) == 1
+
+def test_job_script_memory():
+    plan = plan_images(8, 1, 3)
+    script, overrides = job_script(plan, 'setup', tasks_per_node = 40, node_memory = 64, task_memory = 4)
+    assert 'xargs -P 16 ' in script
+    assert overrides == '#SBATCH --ntasks-per-node=1\n#SBATCH --cpus-per-task=40\n#SBATCH --mem=65536M'
+
+    script, overrides = job_script(plan, 'setup', array = True, task_memory = 1.5)
+    assert '#SBATCH --mem=1536M' in overrides
+
+def test_staged_run_script():
+    plan = plan_images(8, 1, 3)
+    script = plan.run_script(0, stage=True)
+    assert 'cp -r images $STAGE/' in script
+    assert '-i $IMAGES -f 1 -l 3' in script
+    assert 'cp -r results/. $RUN/results/' in script
+    assert script.endswith('rm -rf $STAGE; rm -r images; if [ "$status" = 0 ]; then marker=finished; else marker=failed; fi; mkdir -p ../$marker; touch ../$marker/0')
+
+    plan = plan_archive(8, 4, chunk_size=2)
+    script = plan.run_script(1, stage=True)
+    assert 'cp -r ../../images $NODE_STAGE/' in script
+    assert '-i $IMAGES -f 3 -l 4' in script
+    script, overrides = job_script(plan, 'setup', stage=True)
+    assert script.endswith('rm -rf {};'.format(planning.NODE_STAGE))
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="Needs a POSIX shell")
+def test_staged_run_script_without_node_stage(tmpdir):
+    # Without a writable scratch folder nobody waits for the node copy
+    plan = plan_archive(8, 4)
+    prepare = plan.run_script(0, stage=True).split('; cd $STAGE')[0]
+    run = tmpdir.mkdir('run0')
+    env = dict(os.environ, TMPDIR='/dev/null/scratch')
+    output = subprocess.check_output(prepare + '; echo $IMAGES', shell=True, cwd=str(run), env=env, stderr=subprocess.STDOUT, timeout=20)
+    assert output.decode('utf-8').strip().endswith('{}/../images'.format(run))
+
+def test_job_script_merge():
+    plan = plan_images(8, 1, 3)
+    assert plan.merge_command() == 'python results.py merged/results run*/results'
+    script, overrides = job_script(plan, 'setup', merge=True)
+    assert script.endswith(' {};'.format(plan.merge_command()))
+    script, overrides = job_script(plan, 'setup', array=True, merge=True)
+    assert 'if [ $( (ls finished; ls failed) 2>/dev/null | wc -l) -ge 3 ] && mkdir .merge 2>/dev/null; then {}; fi;'.format(plan.merge_command()) in script
+
+    # Chunks of a shared image list already have image numbers of the whole list
+    plan = plan_images(8, 1, 3, chunk_size = 4)
+    assert plan.merge_command() == 'python results.py --keep-image-numbers merged/results chunks/run*/results'
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="Needs a POSIX shell")
+def test_tracked_command(tmpdir):
+    # A fake CellProfiler logging two modules for each of three image sets
+    command = "echo out; for i in 1 2 3; do for m in 1 2; do echo \"Image # $i, module M # $m: CPU_time = 0.00 secs\" >&2; done; done"
+    output = subprocess.check_output(
+        ['sh', '-c', tracked_command(command, 3, 'log') + '; echo $status'], cwd=str(tmpdir)
+    )
+    assert output.decode('utf-8') == 'out\n0\n'
+    assert not tmpdir.join(planning.STATUS_FILE).exists()
+    assert len(tmpdir.join('log').readlines()) == 6
+    done, total, start, updated = [int(v) for v in tmpdir.join('progress').read().split()]
+    assert (done, total) == (3, 3)
+    assert start <= updated
+
+    # Without image numbers in the log, the folder is done at the end
+    subprocess.check_call(['sh', '-c', tracked_command('true', 4, 'log')], cwd=str(tmpdir))
+    assert tmpdir.join('progress').read().split()[:2] == ['4', '4']
+
+    # The exit status of CellProfiler is kept
+    output = subprocess.check_output(['sh', '-c', tracked_command('false', 4, 'log') + '; echo $status'], cwd=str(tmpdir))
+    assert output.decode('utf-8') == '1\n'
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="Needs a POSIX shell")
+def test_worker_script(tmpdir):
+    # A fake CellProfiler recording the image sets it was asked to process,
+    # failing on the second chunk
+    bin_dir = tmpdir.mkdir('bin')
+    bin_dir.join('cellprofiler').write(
+        '#!/bin/sh\nmkdir -p results; echo "$@" > results/args\ncase "$*" in *"-f 5 "*) exit 1;; esac\n'
+    )
+    bin_dir.join('cellprofiler').chmod(0o755)
+    run_dir = tmpdir.mkdir('run')
+    run_dir.mkdir('queue')
+
+    plan = plan_images(10, 1, 2, chunk_size = 4)
+    run_dir.join(planning.CHUNK_SCRIPT).write(plan.chunk_script())
+    run_dir.join(planning.CHUNK_RANGES).write(plan.chunk_list())
+    run_dir.join('cellprofiler_worker').write(worker_script())
+    environment = dict(os.environ, PATH=str(bin_dir) + os.pathsep + os.environ['PATH'])
+    subprocess.check_call(['bash', 'cellprofiler_worker'], cwd=str(run_dir), env=environment)
+
+    for k, (first, last) in enumerate(plan.ranges):
+        folder = run_dir.join(plan.folder(k))
+        assert '-f {} -l {}'.format(first, last) in folder.join('results', 'args').read()
+        assert folder.join('progress').read().split()[:2] == [str(last - first + 1)]*2
+    # Only chunks processed successfully are marked finished
+    assert sorted(run_dir.join('finished').listdir()) == [run_dir.join('finished', str(k)) for k in (0, 2)]
+    assert run_dir.join('failed').listdir() == [run_dir.join('failed', '1')]
+
+def test_plan_million_files():
+    file_list = ['file:///data/plate%201/image{:07d}.tif'.format(i) for i in range(1000000)]
+    start = time.time()
+    file_list = normalize_file_list(file_list)
+    plan = plan_images(len(file_list), 4, 40)
+    plan.image_uploads(file_list)
+    assert time.time() - start < 1.5
+    assert plan.n_runs == 40
+    assert sum(last for first, last in plan.ranges) == 250000
@@ -0,0 +1,41 @@
+import threading
+
+from CPRynner.polling import Poller
+
+
+def test_poller_refresh():
+    results = []
+    delivered = threading.Event()
+    def deliver(result):
+        results.append(result)
+        delivered.set()
+
+    poller = Poller(lambda: 'runs', deliver, 0)
+    poller.start()
+    poller.refresh()
+    assert delivered.wait(5)
+    poller.stop()
+    poller.thread.join(5)
+    assert results == ['runs']
+    assert not poller.thread.is_alive()
+
+def test_poller_backoff():
+    calls = []
+    errors = []
+    recovered = threading.Event()
+    def fetch():
+        calls.append(1)
+        if len(calls) < 3:
+            raise IOError('offline')
+        return 'runs'
+
+    poller = Poller(fetch, lambda result: recovered.set(), 0.01, max_interval=0.03, on_error=errors.append)
+    assert poller.delay() == 0.01
+    poller.failures = 5
+    assert poller.delay() == 0.03
+    poller.failures = 0
+    poller.start()
+    assert recovered.wait(5)
+    poller.stop()
+    assert len(errors) == 2
+    assert poller.failures == 0
@@ -0,0 +1,64 @@
+from CPRynner.progress import progress_command, parse_progress, summarize, format_progress, update_progress
+
+
+OUTPUT = """\
+runs/a/run0/progress:10 10 1000 1100
+runs/a/run1/progress:5 10 1000 1050
+runs/a/run2/progress:
+runs/b c/run10/progress:0 20 2000 2000
+runs/e/chunks/run3/progress:2 4 3000 3010
+"""
+
+
+def test_progress_command():
+    assert progress_command(['runs/a', 'runs/b c']) == (
+        "grep -s -H . runs/a/run*/progress runs/a/chunks/run*/progress "
+        "'runs/b c'/run*/progress 'runs/b c'/chunks/run*/progress"
+    )
+
+def test_parse_progress():
+    progress = parse_progress(OUTPUT)
+    assert sorted(progress) == ['runs/a', 'runs/b c', 'runs/e']
+    # Files being written are skipped
+    assert sorted(progress['runs/a']) == ['run0', 'run1']
+    assert progress['runs/a']['run1'] == {'done': 5, 'total': 10, 'start': 1000, 'updated': 1050}
+    assert progress['runs/b c']['run10']['total'] == 20
+    # Chunks of a dynamic run count towards the run
+    assert progress['runs/e']['run3']['done'] == 2
+
+def test_summarize():
+    groups = parse_progress(OUTPUT)['runs/a']
+    summary = summarize(groups, 40, now=1150)
+    assert summary['done'] == 15
+    assert summary['percent'] == 37.5
+    # 15 image sets in 150 seconds, 25 to go
+    assert summary['rate'] == 0.1
+    assert summary['finish'] == 1400
+    # Only the unfinished folder counts for stalling
+    assert summary['updated'] == 1050
+
+    assert summary['groups']['run0']['percent'] == 100
+    assert summary['groups']['run0']['finish'] == 1100
+    assert summary['groups']['run1']['rate'] == 0.1
+    assert summary['groups']['run1']['finish'] == 1100
+
+    summary = summarize(parse_progress(OUTPUT)['runs/b c'], now=2010)
+    assert summary['rate'] is None
+    assert summary['finish'] is None
+
+def test_format_progress():
+    groups = parse_progress(OUTPUT)['runs/a']
+    summary = summarize(groups, 40, now=1150)
+    assert format_progress(summary, now=1150).startswith('38%, 0.10/s, done ')
+    assert format_progress(summary, now=1050 + 3600) == '38%, 0.10/s, stalled 60 min'
+    assert format_progress(summary['groups']['run0']) == '100%'
+
+def test_update_progress(fake_channel):
+    channel = fake_channel(OUTPUT)
+    runs = [{'remote_dir': 'runs/a/', 'image_sets': 40}, {'remote_dir': 'runs/b c'}, {'remote_dir': 'runs/d'}, {}]
+    update_progress(channel, runs)
+    assert len(channel.commands) == 1
+    assert runs[0]['progress']['total'] == 40
+    assert runs[1]['progress']['total'] == 20
+    assert 'progress' not in runs[2]
+    assert 'progress' not in runs[3]
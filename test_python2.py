@@ -0,0 +1,29 @@
+import os
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# CellProfiler 3 runs on Python 2. Set PYTHON2 to the interpreter to use
+PYTHON2 = os.environ.get('PYTHON2', 'python2.7')
+
+IMPORT_SCRIPT = """
+import stubs
+stubs.install(['wx', 'cellprofiler', 'numpy', 'future', 'timeago', 'box'])
+import CPRynner.CPRynner, CPRynner.planning, CPRynner.transfer, CPRynner.results
+import CPRynner.slurm, CPRynner.progress, CPRynner.session, CPRynner.runcache, CPRynner.polling
+import runoncluster, clusterview
+"""
+
+
+def python2_available():
+    try:
+        return subprocess.call([PYTHON2, '-c', 'import sys; sys.exit(sys.version_info[0] != 2)']) == 0
+    except OSError:
+        return False
+
+
+@pytest.mark.skipif(not python2_available(), reason="Python 2 is not installed")
+def test_python2_imports():
+    subprocess.check_call([PYTHON2, '-c', IMPORT_SCRIPT], cwd=ROOT)
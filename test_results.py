@@ -0,0 +1,102 @@
+import csv
+
+from CPRynner.results import CSVMerger, merge_csv_files, merge_result_folders, open_csv
+
+
+def write_csv(path, rows):
+    with open_csv(str(path), 'w') as outfile:
+        csv.writer(outfile).writerows(rows)
+
+def read_csv(path):
+    with open_csv(str(path)) as infile:
+        return list(csv.reader(infile))
+
+def test_merge_image_numbers(tmpdir):
+    header = ['ImageNumber', 'ObjectNumber', 'FileName']
+    write_csv(tmpdir.join('run0.csv'), [header, ['1', '1', 'a, b.tif'], ['2', '1', 'c.tif']])
+    write_csv(tmpdir.join('run1.csv'), [header, ['1', '1', 'd.tif'], ['1', '2', 'd.tif']])
+    write_csv(tmpdir.join('run2.csv'), [header, ['1', '1', 'e.tif']])
+
+    destination = tmpdir.join('merged.csv')
+    merge_csv_files([str(tmpdir.join('run{}.csv'.format(n))) for n in range(3)], str(destination))
+    assert read_csv(destination) == [
+        header,
+        ['1', '1', 'a, b.tif'],
+        ['2', '1', 'c.tif'],
+        ['3', '1', 'd.tif'],
+        ['3', '2', 'd.tif'],
+        ['4', '1', 'e.tif'],
+    ]
+
+def test_merge_into_existing(tmpdir):
+    header = ['ImageNumber_First', 'ObjectNumber_First', 'ImageNumber_Second', 'Relationship']
+    destination = tmpdir.join('Object relationships.csv')
+    write_csv(destination, [header, ['1', '1', '2', 'Parent']])
+    # Columns in a different order are rearranged
+    write_csv(tmpdir.join('run1.csv'), [
+        ['Relationship', 'ImageNumber_First', 'ObjectNumber_First', 'ImageNumber_Second'],
+        ['Child', '1', '3', '1'],
+    ])
+
+    merger = CSVMerger()
+    merger.merge(str(tmpdir.join('run1.csv')), str(destination))
+    merger.merge(str(tmpdir.join('run1.csv')), str(destination))
+    assert read_csv(destination) == [
+        header,
+        ['1', '1', '2', 'Parent'],
+        ['3', '3', '3', 'Child'],
+        ['4', '3', '4', 'Child'],
+    ]
+
+def test_merge_without_image_number(tmpdir):
+    destination = tmpdir.join('Experiment.csv')
+    write_csv(destination, [['Key', 'Value'], ['Version', '3']])
+    write_csv(tmpdir.join('run1.csv'), [['Key', 'Value'], ['Version', '3']])
+    CSVMerger().merge(str(tmpdir.join('run1.csv')), str(destination))
+    assert read_csv(destination) == [['Key', 'Value'], ['Version', '3'], ['Version', '3']]
+
+def test_merge_ranged_result_folders(tmpdir):
+    # Chunks of a shared image list, processed with -f 1 -l 2 and -f 3 -l 4
+    header = ['ImageNumber', 'ObjectNumber']
+    for n, rows in enumerate([[['1', '1'], ['2', '1']], [['3', '1'], ['3', '2'], ['4', '1']]]):
+        folder = tmpdir.join('run{}'.format(n), 'results')
+        folder.ensure(dir=True)
+        write_csv(folder.join('Nuclei.csv'), [header] + rows)
+
+    merged = tmpdir.join('merged', 'results')
+    folders = [str(tmpdir.join('run{}'.format(n), 'results')) for n in range(2)]
+    merge_result_folders(folders, str(merged), renumber=False)
+    assert read_csv(merged.join('Nuclei.csv')) == [
+        header, ['1', '1'], ['2', '1'], ['3', '1'], ['3', '2'], ['4', '1'],
+    ]
+
+def test_merge_result_folders(tmpdir):
+    header = ['ImageNumber', 'Count']
+    for n in [0, 1, 10]:
+        folder = tmpdir.join('run{}'.format(n), 'results')
+        folder.ensure(dir=True)
+        write_csv(folder.join('Image.csv'), [header, ['1', str(n)]])
+        folder.join('outline.png').write('png{}'.format(n))
+
+    merged = tmpdir.join('merged', 'results')
+    folders = [str(tmpdir.join('run{}'.format(n), 'results')) for n in [10, 0, 1]]
+    merge_result_folders(folders, str(merged))
+    assert read_csv(merged.join('Image.csv')) == [header, ['1', '0'], ['2', '1'], ['3', '10']]
+    assert sorted(f.basename for f in merged.listdir()) == ['Image.csv', 'outline.png', 'outline_2.png', 'outline_3.png']
+    assert merged.join('outline_3.png').read() == 'png10'
+
+def test_merge_result_folders_without_objects_on_last_image(tmpdir):
+    # The last image of run0 has no nuclei, so Nuclei.csv ends before Image.csv
+    images = [[['1'], ['2']], [['1'], ['2']]]
+    nuclei = [[['1', '1']], [['1', '1'], ['2', '1']]]
+    for n in range(2):
+        folder = tmpdir.join('run{}'.format(n), 'results')
+        folder.ensure(dir=True)
+        write_csv(folder.join('Image.csv'), [['ImageNumber']] + images[n])
+        write_csv(folder.join('Nuclei.csv'), [['ImageNumber', 'ObjectNumber']] + nuclei[n])
+
+    merged = tmpdir.join('merged', 'results')
+    merge_result_folders([str(tmpdir.join('run{}'.format(n), 'results')) for n in range(2)], str(merged))
+    assert read_csv(merged.join('Image.csv')) == [['ImageNumber'], ['1'], ['2'], ['3'], ['4']]
+    # The nuclei of run1 still belong to its images
+    assert read_csv(merged.join('Nuclei.csv')) == [['ImageNumber', 'ObjectNumber'], ['1', '1'], ['3', '1'], ['4', '1']]
@@ -0,0 +1,58 @@
+import json
+import sys
+
+import pytest
+
+from CPRynner.runcache import RunCache, is_finished, with_defaults, read_runs, RUN_CONFIG
+
+
+def test_run_cache(tmpdir):
+    path = str(tmpdir.join('runs.sqlite'))
+    cache = RunCache(path)
+    assert cache.runs() == []
+
+    runs = [
+        {'id': 'a', 'job_name': 'first', 'upload_time': 1, 'status': 'COMPLETED', 'downloads': [['run0', '/out']]},
+        {'id': 'b', 'job_name': 'second', 'upload_time': 2, 'status': 'PENDING', 'qid': '123'},
+    ]
+    cache.save(runs)
+    assert [r['id'] for r in RunCache(path).runs()] == ['b', 'a']
+
+    runs[1]['status'] = 'COMPLETED'
+    runs[1]['downloaded'] = True
+    cache.save([runs[1]])
+    assert cache.runs()[0] == with_defaults(runs[1])
+    assert len(cache.runs()) == 2
+
+    cache.save([runs[0]], replace=True)
+    assert cache.runs() == [with_defaults(runs[0])]
+
+def test_is_finished():
+    assert is_finished({'status': 'COMPLETED'})
+    assert not is_finished({'status': 'PENDING'})
+    assert not is_finished({})
+
+def test_with_defaults():
+    # A run that has just been submitted
+    assert with_defaults({'upload_time': 5}) == {'upload_time': 5, 'status': 'PENDING', 'status_time': 5, 'starttime': ''}
+    run = {'upload_time': 5, 'status': 'COMPLETED', 'status_time': 9, 'starttime': 'x'}
+    assert with_defaults(dict(run)) == run
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="Needs a POSIX shell")
+def test_read_runs(tmpdir, fake_channel):
+    work_dir = tmpdir.mkdir('work dir')
+    # No runs yet, left to Rynner
+    assert read_runs(fake_channel(), str(work_dir)) is None
+
+    work_dir.mkdir('a').join(RUN_CONFIG).write(json.dumps({'id': 'a', 'downloads': [['run0', '/out']]}))
+    work_dir.mkdir('b').join(RUN_CONFIG).write(json.dumps({'id': 'b'}, indent=2))
+    work_dir.mkdir('cache')
+    channel = fake_channel()
+    runs = read_runs(channel, str(work_dir))
+    assert sorted(r['id'] for r in runs) == ['a', 'b']
+    assert runs[0]['downloads'] == [['run0', '/out']]
+    assert len(channel.commands) == 1
+
+    # Configurations in another format are left to Rynner
+    work_dir.mkdir('c').join(RUN_CONFIG).write('id: c')
+    assert read_runs(fake_channel(), str(work_dir)) is None
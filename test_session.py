@@ -0,0 +1,29 @@
+from CPRynner.session import Session
+
+
+def test_session_reconnects(fake_ssh_client):
+    clients = []
+    def connect():
+        clients.append(fake_ssh_client(flaky=len(clients) == 0))
+        return clients[-1]
+
+    session = Session(connect, keepalive=15, delay=0)
+    assert session.execute_wait('echo hello') == (0, 'hello\n', '')
+    assert len(clients) == 2
+    assert clients[0].closed
+    assert clients[1].transport.keepalive == 15
+
+    # A dropped connection is noticed before running the next command
+    clients[1].transport.active = False
+    session.execute_wait('ls')
+    assert len(clients) == 3
+    session.close()
+    assert clients[2].closed
+
+def test_session_gives_up(fake_ssh_client):
+    session = Session(lambda: fake_ssh_client(flaky=True), attempts=2, delay=0)
+    try:
+        session.execute_wait('ls')
+        assert False
+    except EOFError:
+        pass
@@ -0,0 +1,101 @@
+from CPRynner.slurm import parse_job_states, parse_time, update_runs, status_command, base_job_id
+from CPRynner.slurm import parse_partitions, parse_time_limit, choose_partition
+
+
+QUEUE = """\
+101 RUNNING 2024-05-01T10:00:00
+102 PENDING 2024-05-02T08:30:00
+103_[2-3] PENDING N/A
+103_1 RUNNING 2024-05-01T09:00:00
+"""
+
+ACCOUNTING = """\
+100|COMPLETED|2024-04-30T10:00:00|2024-04-30T10:01:00|2024-04-30T12:00:00
+101|RUNNING|2024-05-01T09:00:00|2024-05-01T10:00:00|Unknown
+103_0|COMPLETED|2024-05-01T08:00:00|2024-05-01T08:10:00|2024-05-01T08:50:00
+104_0|COMPLETED|2024-05-01T08:00:00|2024-05-01T08:10:00|2024-05-01T08:50:00
+104_1|TIMEOUT|2024-05-01T08:00:00|2024-05-01T08:10:00|2024-05-01T09:10:00
+105|CANCELLED by 1000|2024-05-01T08:00:00|None|2024-05-01T08:05:00
+"""
+
+PARTITIONS = """\
+compute*|40|190000|3-00:00:00|20/0/2/22|up
+highmem|40|380000+|3-00:00:00|2/1/0/3|up
+dev|40|190000|1:00:00|0/2/0/2|up
+amd|128|256000|2-00:00:00|4/6/0/10|up
+gpu|40|380000|2-00:00:00|0/4/0/4|down
+"""
+
+
+def test_base_job_id():
+    assert base_job_id('123') == '123'
+    assert base_job_id('123_4') == '123'
+    assert base_job_id('123_[1-5]') == '123'
+    assert base_job_id('123.batch') == '123'
+
+def test_parse_job_states():
+    states = parse_job_states(QUEUE + '----\n' + ACCOUNTING)
+    assert states['100']['status'] == 'COMPLETED'
+    assert states['101']['state'] == 'RUNNING'
+    assert states['101']['status'] == 'PENDING'
+    assert states['102']['starttime'] == '2024-05-02T08:30:00'
+    assert states['102']['status_time'] is None
+    # An array job is active while any of its tasks are
+    assert states['103']['state'] == 'RUNNING'
+    assert states['104']['state'] == 'TIMEOUT'
+    assert states['104']['status'] == 'COMPLETED'
+    assert states['105']['state'] == 'CANCELLED'
+    assert states['100']['status_time'] == parse_time('2024-04-30T12:00:00')
+
+def test_update_runs(fake_channel):
+    channel = fake_channel(QUEUE + '----\n' + ACCOUNTING)
+    runs = [{'qid': '100'}, {'qid': 102, 'status_time': 5}, {'qid': '999'}, {'id': 'not submitted'}]
+    update_runs(channel, runs)
+    assert len(channel.commands) == 1
+    assert channel.commands[0] == status_command(['100', '102', '999'])
+    assert runs[0]['status'] == 'COMPLETED'
+    assert runs[1]['status'] == 'PENDING'
+    assert runs[1]['status_time'] == 5
+    assert runs[2]['status'] == 'COMPLETED'
+    assert 'status' not in runs[3]
+
+def test_update_runs_failed_query(fake_channel):
+    # Jobs are only taken to be gone once sacct has answered
+    for channel in [fake_channel(QUEUE + '----\n', retcode=1), fake_channel(''), fake_channel('', retcode=-1)]:
+        runs = [{'qid': '101', 'status': 'PENDING', 'slurm_state': 'RUNNING'}, {'qid': '999', 'status': 'PENDING'}]
+        update_runs(channel, runs)
+        assert runs == [{'qid': '101', 'status': 'PENDING', 'slurm_state': 'RUNNING'}, {'qid': '999', 'status': 'PENDING'}]
+
+def test_parse_time_limit():
+    assert parse_time_limit('3-00:00:00') == 72
+    assert parse_time_limit('12:30:00') == 12.5
+    assert parse_time_limit('30:00') == 0.5
+    assert parse_time_limit('infinite') is None
+
+def test_parse_partitions():
+    partitions = parse_partitions(PARTITIONS)
+    assert [p['name'] for p in partitions] == ['compute', 'highmem', 'dev', 'amd']
+    assert partitions[0]['default']
+    assert partitions[0]['memory'] == 185
+    assert partitions[1]['memory'] == 371
+    assert partitions[2]['time_limit'] == 1
+    assert partitions[3]['cpus'] == 128
+    assert partitions[3]['idle'] == 6
+    assert partitions[3]['nodes'] == 10
+
+def test_choose_partition():
+    partitions = parse_partitions(PARTITIONS)
+    # Idle nodes with the most cores
+    assert choose_partition(partitions, 1000, 24)['name'] == 'amd'
+    # Too long for all but the three day partitions
+    assert choose_partition(partitions, 1000, 60)['name'] == 'highmem'
+    assert choose_partition(partitions, 1000, 60, n_nodes=2)['name'] == 'compute'
+    assert choose_partition(partitions, 1000, 100) is None
+    # Memory limits the number of processes on the amd nodes
+    assert choose_partition(partitions, 1000, 24, task_memory=8)['name'] == 'highmem'
+    # A small batch finishes in one round on any idle node, so use more cores
+    assert choose_partition(partitions, 10, 1)['name'] == 'amd'
+    assert choose_partition(partitions, 10, 1, n_nodes=8)['name'] == 'amd'
+    assert choose_partition(partitions, 10, 1, n_nodes=12)['name'] == 'compute'
+    assert choose_partition(partitions, 10, 1, name='dev')['name'] == 'dev'
+    assert choose_partition(partitions, 10, 2, name='dev') is None
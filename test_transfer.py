@@ -0,0 +1,182 @@
+import os
+import tarfile
+
+import pytest
+
+from CPRynner.transfer import pack_archive, archive_name
+from CPRynner.transfer import file_digest, UploadManifest, cache_uploads
+from CPRynner.transfer import TransferPool, TransferManifest, split_files, list_remote_files, find_command
+from CPRynner.transfer import MEASUREMENT_PATTERNS
+
+
+def test_archive_name():
+    assert archive_name() == 'images.tar'
+    assert archive_name(True) == 'images.tar.gz'
+
+def test_pack_archive(tmpdir):
+    files = []
+    for n in range(3):
+        path = tmpdir.join('image{}.tif'.format(n))
+        path.write('data{}'.format(n))
+        files.append(str(path))
+    members = [(f, 'run{}/images/{}'.format(n%2, os.path.basename(f))) for n, f in enumerate(files)]
+
+    for compress in [False, True]:
+        archive = str(tmpdir.join(archive_name(compress)))
+        packed = []
+        pack_archive(archive, members, compress, packed.append)
+        assert packed == [1, 2, 3]
+        with tarfile.open(archive) as tar:
+            assert tar.getnames() == [m[1] for m in members]
+            assert tar.extractfile('run1/images/image1.tif').read() == b'data1'
+
+def test_upload_manifest(tmpdir):
+    image = tmpdir.join('image.tif')
+    image.write('data')
+    manifest = UploadManifest(str(tmpdir.join('manifest.json')))
+    digest = manifest.digest(str(image))
+    assert digest == file_digest(str(image))
+    manifest.save()
+
+    manifest = UploadManifest(str(tmpdir.join('manifest.json')))
+    assert manifest.entries[str(image)][2] == digest
+
+def test_cache_uploads(tmpdir):
+    paths = []
+    for n in range(3):
+        image = tmpdir.join('image{}.tif'.format(n))
+        image.write('data{}'.format(n))
+        paths.append(str(image))
+    manifest = UploadManifest(str(tmpdir.join('manifest.json')))
+    uploads = [[paths[0], 'run0/images'], [paths[1], 'run0/images'], [paths[2], 'run1/images']]
+    cached = set([manifest.digest(paths[1])])
+
+    counts = []
+    remaining, script = cache_uploads(uploads, manifest, '/scratch/cache', cached, counts.append)
+    assert remaining == [uploads[0], uploads[2]]
+    assert counts == [1, 2, 3]
+    lines = script.splitlines()
+    assert lines[0] == 'mkdir -p /scratch/cache'
+    assert 'mkdir -p run1/images' in lines
+    assert 'ln -f /scratch/cache/{0} run0/images/image1.tif 2>/dev/null || cp /scratch/cache/{0} run0/images/image1.tif'.format(
+        manifest.digest(paths[1])) in lines
+    assert 'ln -f run1/images/image2.tif /scratch/cache/{0} 2>/dev/null || cp run1/images/image2.tif /scratch/cache/{0}'.format(
+        manifest.digest(paths[2])) in lines
+
+
+def test_transfer_pool(tmpdir, fake_ssh_client):
+    files = []
+    for n in range(10):
+        image = tmpdir.join('image{}.tif'.format(n))
+        image.write('data{}'.format(n))
+        files.append((str(image), str(tmpdir.join('remote', 'run{}'.format(n%3), 'image{}.tif'.format(n)))))
+
+    pool = TransferPool(fake_ssh_client, 4)
+    pool.start_upload(files)
+    pool.wait()
+    assert pool.progress() == 1
+    for local, remote in files:
+        assert open(remote).read() == open(local).read()
+    completed = pool.pop_completed()
+    assert sorted(completed) == sorted(
+        (local, remote, 5, file_digest(local)) for local, remote in files
+    )
+    assert pool.pop_completed() == []
+    pool.close()
+
+def test_split_files():
+    files = [('a', 10), ('b', 1), ('c', 5), ('d', 5), ('e', 1)]
+    assert split_files(files, 2) == [['a', 'b'], ['c', 'd', 'e']]
+    assert split_files(files, 3) == [['a'], ['b', 'c'], ['d', 'e']]
+    assert split_files(files[:1], 4) == [['a']]
+
+def test_archive_download(tmpdir, fake_ssh_client, fake_channel):
+    remote = tmpdir.join('remote')
+    for n in range(3):
+        remote.join('run{}'.format(n), 'results', 'Image.csv').write('csv{}'.format(n), ensure=True)
+        remote.join('run{}'.format(n), 'results', 'outline.png').write('png{}'.format(n), ensure=True)
+
+    pool = TransferPool(fake_ssh_client, 2)
+    local = tmpdir.join('local')
+    files = list_remote_files(fake_channel(), str(remote), ['run0', 'run2'], MEASUREMENT_PATTERNS)
+    pool.start_archive_download(str(remote), files, str(local))
+    pool.wait()
+    assert len(pool.threads) == 2
+    assert pool.progress() == 1
+    assert local.join('run0', 'results', 'Image.csv').read() == 'csv0'
+    assert local.join('run2', 'results', 'Image.csv').read() == 'csv2'
+    assert not local.join('run1').exists()
+    assert not local.join('run0', 'results', 'outline.png').exists()
+    # The file lists are removed from the cluster
+    assert sorted(os.listdir(str(remote))) == ['run0', 'run1', 'run2']
+
+    pool.start_archive_download(str(remote), [('run1/results/outline.png', 4)], str(local))
+    pool.wait()
+    assert local.join('run1', 'results', 'outline.png').read() == 'png1'
+    pool.close()
+
+def test_transfer_manifest(tmpdir):
+    image = tmpdir.join('image.tif')
+    image.write('data')
+    manifest = TransferManifest(str(tmpdir.join('transfers', 'run.json')), {'id': 'run'})
+    manifest.mark_done('run0/images/image.tif', 4, 'abc')
+    manifest.mark_done('run1/images/image.tif', 4, 'def')
+    assert manifest.is_done('run0/images/image.tif', str(image))
+    assert not manifest.is_done('run2/images/image.tif', str(image))
+    assert manifest.pop_new_lines() == 'abc 4 run0/images/image.tif\ndef 4 run1/images/image.tif\n'
+    assert manifest.pop_new_lines() == ''
+    manifest.save()
+
+    manifest = TransferManifest(str(tmpdir.join('transfers', 'run.json')))
+    assert manifest.run == {'id': 'run'}
+    # The second file was not confirmed on the cluster
+    manifest.verify(['abc 4 run0/images/image.tif\n'], {'run0/images/image.tif': 4, 'run1/images/image.tif': 4})
+    assert list(manifest.done.keys()) == ['run0/images/image.tif']
+    manifest.remove()
+    assert not tmpdir.join('transfers', 'run.json').exists()
+
+def test_transfer_manifest_sources(tmpdir):
+    image = tmpdir.join('image.tif')
+    image.write('data')
+    script = tmpdir.join('cellprofiler_run0')
+    script.write('cellprofiler')
+    manifest = TransferManifest(str(tmpdir.join('transfers', 'run.json')), {'id': 'run'})
+    manifest.record_sources([str(image), str(script)])
+    manifest.save()
+
+    manifest = TransferManifest(str(tmpdir.join('transfers', 'run.json')))
+    assert manifest.changed_sources() == []
+    # A later run wrote a different script, and the image was removed
+    script.write('cellprofiler -c')
+    image.remove()
+    assert manifest.changed_sources() == [str(script), str(image)]
+
+def test_transfer_pool_retry(tmpdir, fake_ssh_client):
+    image = tmpdir.join('image.tif')
+    image.write('data')
+    remote = str(tmpdir.join('remote', 'image.tif'))
+    clients = []
+    def drop_connection(*args):
+        raise EOFError()
+    class FlakySSHClient(fake_ssh_client):
+        # The first connection drops during the upload
+        def open_sftp(self):
+            sftp = fake_ssh_client.open_sftp(self)
+            if len(clients) == 1:
+                sftp.putfo = drop_connection
+            return sftp
+    def connect():
+        clients.append(FlakySSHClient())
+        return clients[-1]
+
+    pool = TransferPool(connect, 1, retry_delay=0)
+    pool.start_upload([(str(image), remote)])
+    pool.wait()
+    assert open(remote).read() == 'data'
+    assert len(clients) == 2
+
+def test_find_command():
+    assert find_command(['run0', 'b c'], ['*.csv']) == "find run0 'b c' -type f \\( -name '*.csv' \\)"
+    # An empty list would make find list the whole run directory
+    with pytest.raises(ValueError):
+        find_command([])